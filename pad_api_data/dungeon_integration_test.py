@@ -26,6 +26,8 @@ def parse_args():
     inputGroup = parser.add_argument_group("Input")
     inputGroup.add_argument("--input_dir", required=True,
                             help="Path to a folder where the input data is")
+    inputGroup.add_argument("--cache_dir", required=False,
+                            help="Path to a folder where parsed snapshots of the input data are cached")
 
     outputGroup = parser.add_argument_group("Output")
     outputGroup.add_argument("--output_dir", required=True,
@@ -47,7 +49,7 @@ def run_test(args):
     golden_output_dir = os.path.join(output_dir, 'golden')
     pathlib.Path(golden_output_dir).mkdir(parents=True, exist_ok=True)
 
-    db = database.Database('na', raw_input_dir)
+    db = database.Database('na', raw_input_dir, cache_dir=args.cache_dir)
     print('loading')
     db.load_database(skip_skills=True, skip_bonus=True, skip_extra=True)
 
@@ -0,0 +1,106 @@
+"""
+Checks loop detection in the enemy skillset processor against hand-built behaviors.
+
+Unlike the integration tests this needs no input data; each case is a minimal
+behavior list reproducing a card whose skillset changed when loops started being
+found from repeated simulator states.
+
+Run with: python -m unittest enemy_skillset_loop_test
+"""
+
+import unittest
+
+from pad_etl.data.card import EnemySkillRef
+from pad_etl.processor import enemy_skillset as es
+from pad_etl.processor import enemy_skillset_dump as esd
+from pad_etl.processor import enemy_skillset_processor as esp
+
+
+class FakeCard(object):
+    def __init__(self, card_id):
+        self.card_id = card_id
+        self.enemy_skill_effect_type = 1
+
+
+def make_skill(enemy_skill_id, skill_type):
+    return es.DictWithAttributeAccess({
+        'enemy_skill_id': enemy_skill_id,
+        'name': 'skill {}'.format(enemy_skill_id),
+        'type': skill_type,
+        'params': [None] * 16,
+    })
+
+
+REGISTRY = es.EnemySkillRegistry([
+    make_skill(1, 1),  # default attack
+    make_skill(10, 32),  # branch if counter > ai
+    make_skill(11, 62),  # blind
+    make_skill(12, 26),  # counter + 1
+    make_skill(20, 37),  # countdown
+    make_skill(21, 15),  # multihit, no attack params
+    make_skill(22, 25),  # counter = ai
+])
+
+
+def simulate(skill_refs):
+    card = FakeCard(1)
+    behaviors = es.extract_behavior(card, skill_refs, REGISTRY)
+    skillset = esp.convert(card, behaviors, 1, 0, card.enemy_skill_effect_type, REGISTRY)
+    return skillset, skillset.moveset.hp_actions[0]
+
+
+class EnemySkillsetLoopTest(unittest.TestCase):
+    def test_exhausted_counter_is_timed(self):
+        # Blinds until the counter passes 17, then branches past the end and idles
+        # (like na 936). Searching the 20 simulated turns for a repeat reported this as a
+        # 7 turn repeating blind.
+        skillset, actions = simulate([
+            EnemySkillRef(10, 17, 28),
+            EnemySkillRef(11, 38, 47),
+            EnemySkillRef(12, 0, 0),
+        ])
+
+        self.assertEqual([(1, 17, [11])],
+                         [(g.turn, g.end_turn, [s.enemy_skill_id for s in g.skills]) for g in actions.timed])
+        self.assertEqual([], actions.repeating)
+        self.assertEqual([], skillset.turn_ceiling_hps)
+
+    def test_long_countdown_loop(self):
+        # Attacks, then counts down from 18 over 19 turns (like na 2428). Searching the 20
+        # simulated turns for a repeat couldn't confirm a loop that long and failed with
+        # 'No loop found'.
+        skillset, actions = simulate([
+            EnemySkillRef(20, 0, 0),
+            EnemySkillRef(21, 77, 95),
+            EnemySkillRef(22, 19, 0),
+        ])
+
+        self.assertEqual([], actions.timed)
+        self.assertEqual([19] * 19, [g.interval for g in actions.repeating])
+        self.assertEqual([21] + [counter * 1000 + 20 for counter in range(18, 0, -1)],
+                         [g.skills[0].enemy_skill_id for g in actions.repeating])
+
+        # The multihit has no attack, which used to break its description.
+        esd.flatten_skillset(1, skillset)
+
+    def test_state_never_repeats(self):
+        # Counts up forever, so no state repeats before the turn ceiling. The loop is
+        # then searched for in the first CHECKPOINT_TURNS turns only.
+        skill_refs = [
+            EnemySkillRef(12, 0, 0),
+            EnemySkillRef(21, 77, 95),
+        ]
+        behaviors = es.extract_behavior(FakeCard(1), skill_refs, REGISTRY)
+        turn_data, cycle = esp.extract_turn_behaviors(esp.CTXCounter(1, 0, REGISTRY), behaviors, 100)
+        self.assertIsNone(cycle)
+        self.assertEqual(esp.DEFAULT_MAX_TURNS, len(turn_data))
+
+        skillset, actions = simulate(skill_refs)
+        self.assertEqual([100, 0], skillset.turn_ceiling_hps)
+        self.assertEqual([], actions.timed)
+        self.assertEqual([(1, [21])], [(g.interval, [s.enemy_skill_id for s in g.skills])
+                                       for g in actions.repeating])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@ import time
 
 from pad_etl.api import pad_api
 
-from pad_etl.storage.db_util import DbWrapper
+from pad_etl.storage.db_util import BatchWriter, DbWrapper
 from pad_etl.storage.wave import WaveItem
 
 
@@ -22,6 +22,7 @@ def parse_args():
     inputGroup.add_argument("--dungeon_id", required=True, help="Dungeon ID")
     inputGroup.add_argument("--floor_id", required=True, help="Floor ID")
     inputGroup.add_argument("--loop_count", type=int, default=100, help="Number of entry attempts")
+    inputGroup.add_argument("--batch_size", type=int, default=500, help="Number of wave rows per insert")
 
     outputGroup = parser.add_argument_group("Output")
     outputGroup.add_argument("--db_config", required=True, help="JSON database info")
@@ -70,22 +71,29 @@ def pull_data(args):
     db_wrapper = DbWrapper(dry_run)
     db_wrapper.connect(db_config)
 
+    # Same columns that WaveItem.insert_sql writes
+    wave_cols = list(WaveItem()._insert_columns())
+    wave_writer = BatchWriter(db_wrapper, WaveItem.TABLE, wave_cols, batch_size=args.batch_size)
+
     print('entering dungeon', dungeon_id, 'floor', floor_id, loop_count, 'times')
-    for entry_id in range(loop_count):
-        print('entering', entry_id)
-        entry_id = int(time.time())
-        entry_json = api_client.enter_dungeon(dungeon_id, floor_id, self_card=friend_card)
-        wave_response = pad_api.extract_wave_response_from_entry(entry_json)
-        leaders = entry_json['entry_leads']
-
-        for stage_idx, floor in enumerate(wave_response.floors):
-            for monster_idx, monster in enumerate(floor.monsters):
-                wave_item = WaveItem(pull_id=pull_id, entry_id=entry_id, server=server, dungeon_id=dungeon_id,
-                                     floor_id=floor_id, stage=stage_idx, slot=monster_idx, monster=monster,
-                                     leader_id=leaders[0], friend_id=leaders[1])
-                db_wrapper.insert_item(wave_item.insert_sql())
-
-        time.sleep(2)
+    with wave_writer:
+        for entry_id in range(loop_count):
+            print('entering', entry_id)
+            entry_id = int(time.time())
+            entry_json = api_client.enter_dungeon(dungeon_id, floor_id, self_card=friend_card)
+            wave_response = pad_api.extract_wave_response_from_entry(entry_json)
+            leaders = entry_json['entry_leads']
+
+            for stage_idx, floor in enumerate(wave_response.floors):
+                for monster_idx, monster in enumerate(floor.monsters):
+                    wave_item = WaveItem(pull_id=pull_id, entry_id=entry_id, server=server, dungeon_id=dungeon_id,
+                                         floor_id=floor_id, stage=stage_idx, slot=monster_idx, monster=monster,
+                                         leader_id=leaders[0], friend_id=leaders[1])
+                    wave_writer.add(wave_item)
+
+            time.sleep(2)
+
+    print('saved', wave_writer.rows_written, 'wave rows')
 
 
 if __name__ == '__main__':
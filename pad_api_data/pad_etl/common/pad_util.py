@@ -1,4 +1,6 @@
+import calendar
 import datetime
+import functools
 import json
 import re
 
@@ -53,8 +55,37 @@ def ghtime(time_str: str, server: str) -> datetime.datetime:
     return datetime.datetime.strptime(timezone_str, '%y%m%d%H%M%S %z')
 
 
+# Same offsets as ghtime, in seconds east of UTC.
+GH_UTC_OFFSETS = {
+    'na': -8 * 60 * 60,
+    'jp': 9 * 60 * 60,
+}
+
+
+@functools.lru_cache(maxsize=8192)
 def gh_to_timestamp(time_str: str, server: str) -> int:
-    """Converts a time string to a timestamp."""
+    """Converts a time string to a timestamp.
+
+    Well-formed yymmddHHMMSS strings are decoded arithmetically; anything else
+    goes through ghtime so that errors and odd formats behave the same.
+    Results are memoized, since bonus/exchange files repeat the same times a lot.
+    """
+    server = server.lower()
+    server = 'jp' if server == 'ja' else server
+    utc_offset = GH_UTC_OFFSETS[server]
+
+    if len(time_str) == 12 and time_str.isascii() and time_str.isdigit():
+        yy = int(time_str[0:2])
+        year = 2000 + yy if yy < 69 else 1900 + yy  # Same pivot as strptime's %y
+        month = int(time_str[2:4])
+        day = int(time_str[4:6])
+        hour = int(time_str[6:8])
+        minute = int(time_str[8:10])
+        second = int(time_str[10:12])
+        if (1 <= month <= 12 and 1 <= day <= calendar.monthrange(year, month)[1]
+                and hour < 24 and minute < 60 and second < 60):
+            return calendar.timegm((year, month, day, hour, minute, second)) - utc_offset
+
     dt = ghtime(time_str, server)
     return int(dt.timestamp())
 
@@ -111,6 +142,39 @@ class JsonDictEncodable(json.JSONEncoder):
         return str(self.__dict__)
 
 
+class JsonSlotsEncodable(object):
+    """Compact alternative to JsonDictEncodable for objects held in bulk.
+
+    Children declare their fields in __slots__ instead of carrying a per-instance
+    dict. A read-only __dict__ is synthesized from the slots so that JSON dumping
+    via `default=lambda x: x.__dict__`, vars(), str() and pickling keep working.
+    """
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        slot_names = []
+        for klass in reversed(cls.__mro__):
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in slot_names:
+                    slot_names.append(name)
+        cls._slot_names = tuple(slot_names)
+
+    @property
+    def __dict__(self):
+        return {name: getattr(self, name) for name in self._slot_names if hasattr(self, name)}
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
 # directly into a dictionary when multiple val's correspond to a single
 # comment, but are unnecessarily delineated
 def get_dungeon_comment(val: int) -> str:
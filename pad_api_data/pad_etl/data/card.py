@@ -5,7 +5,7 @@ Parses card data.
 import json
 import math
 import os
-from typing import List, Any
+from typing import Any, Dict, List
 
 from ..common import pad_util
 from ..common.shared_types import AttrId, CardId, SkillId, TypeId
@@ -33,9 +33,31 @@ class Curve(pad_util.JsonDictEncodable):
         return self.min_value + (self.max_value - self.min_value) * math.pow(f, self.scale)
 
 
-class EnemySkillRef(pad_util.JsonDictEncodable):
+class CurveTable(object):
+    """A Curve that remembers value_at for each level it has been asked about.
+
+    Values are computed with Curve.value_at, so lookups are bit-identical to it.
+    """
+
+    __slots__ = ('curve', 'values')
+
+    def __init__(self, curve: Curve):
+        self.curve = curve
+        self.values = {}  # type: Dict[int, float]
+
+    def value_at(self, level: int):
+        value = self.values.get(level)
+        if value is None:
+            value = self.curve.value_at(level)
+            self.values[level] = value
+        return value
+
+
+class EnemySkillRef(pad_util.JsonSlotsEncodable):
     """Describes how this monster uses an enemy skill"""
 
+    __slots__ = ('enemy_skill_id', 'enemy_ai', 'enemy_rnd')
+
     def __init__(self, enemy_skill_id: int, enemy_ai: int, enemy_rnd: int):
         self.enemy_skill_id = enemy_skill_id
         self.enemy_ai = enemy_ai
@@ -64,9 +86,26 @@ class Enemy(pad_util.JsonDictEncodable):
         self.enemy_skill_refs = enemy_skill_refs
 
 
-class BookCard(pad_util.JsonDictEncodable):
+class BookCard(pad_util.JsonSlotsEncodable):
     """Data about a player-ownable monster."""
 
+    # Several full card lists are held at once (raw/merged, JP/NA), so avoid a dict per card.
+    __slots__ = ('card_id', 'name', 'attr_id', 'sub_attr_id', 'is_ult', 'type_1_id', 'type_2_id',
+                 'rarity', 'cost', 'unknown_009', 'max_level', 'feed_xp_at_lvl_4',
+                 'released_status', 'sell_price_at_lvl_10', 'min_hp', 'max_hp', 'hp_scale',
+                 'min_atk', 'max_atk', 'atk_scale', 'min_rcv', 'max_rcv', 'rcv_scale', 'xp_max',
+                 'xp_scale', 'active_skill_id', 'leader_skill_id', 'enemy_turns', 'enemy_hp_min',
+                 'enemy_hp_max', 'enemy_hp_scale', 'enemy_atk_min', 'enemy_atk_max',
+                 'enemy_atk_scale', 'enemy_def_min', 'enemy_def_max', 'enemy_def_scale',
+                 'enemy_max_level', 'enemy_coins_at_lvl_2', 'enemy_xp_at_lvl_2', 'ancestor_id',
+                 'evo_mat_id_1', 'evo_mat_id_2', 'evo_mat_id_3', 'evo_mat_id_4', 'evo_mat_id_5',
+                 'un_evo_mat_1', 'un_evo_mat_2', 'un_evo_mat_3', 'un_evo_mat_4', 'un_evo_mat_5',
+                 'enemy_turns_alt', 'unknown_052', 'enemy_skill_effect', 'enemy_skill_effect_type',
+                 'unknown_055', 'unknown_056', 'enemy_skill_refs', 'awakenings',
+                 'super_awakenings', 'base_id', 'group_id', 'type_3_id', 'sell_mp',
+                 'latent_on_feed', 'collab_id', 'random_flags', 'inheritable', 'is_collab',
+                 'furigana', 'limit_mult', 'voice_id', 'other_fields')
+
     def __init__(self, raw: List[Any]):
         unflatten(raw, 57, 3, replace=True)
         unflatten(raw, 58, 1, replace=True)
@@ -212,6 +251,18 @@ class BookCard(pad_util.JsonDictEncodable):
                            max_level=self.enemy_max_level),
                      self.enemy_skill_refs)
 
+    def enemy_table(self):
+        """Same as enemy(), but each stat curve remembers the levels it was asked for."""
+        enemy = self.enemy()
+        return Enemy(enemy.turns,
+                     CurveTable(enemy.hp),
+                     CurveTable(enemy.atk),
+                     CurveTable(enemy.defense),
+                     enemy.max_level,
+                     CurveTable(enemy.coin),
+                     CurveTable(enemy.xp),
+                     enemy.enemy_skill_refs)
+
     def hp_curve(self):
         return Curve(self.min_hp, self.max_hp, self.hp_scale)
 
@@ -231,6 +282,22 @@ class BookCard(pad_util.JsonDictEncodable):
         return 'Card({} - {})'.format(self.card_id, self.name)
 
 
+class EnemyTableCache(object):
+    """Hands out BookCard.enemy_table() results, building each card's tables once."""
+
+    def __init__(self):
+        # Keyed on the card object rather than card_id; JP and NA cards share ids.
+        self._enemies = {}  # type: Dict[BookCard, Enemy]
+
+    def enemy(self, card: BookCard) -> Enemy:
+        enemy = self._enemies.get(card)
+        if enemy is None:
+            enemy = card.enemy_table()
+            self._enemies[card] = enemy
+        return enemy
+
+
+
 def unflatten(raw: List[Any], idx: int, width: int, replace: bool=False):
     """Unflatten a card array.
 
@@ -1,13 +1,36 @@
+from concurrent.futures import ProcessPoolExecutor
 import json
 import logging
 import os
+from typing import Dict, List
 
-from . import bonus, card, dungeon, skill, exchange, enemy_skill
+from . import bonus, card, dungeon, skill, exchange, enemy_skill, intermediate
+from .snapshot_cache import NullSnapshotCache, SnapshotCache, SKIPPED_KEY
 from ..processor import enemy_skillset as enemy_skillset_lib
 from ..processor.merged_data import MergedBonus, MergedCard, MergedEnemy
 
 fail_logger = logging.getLogger('processor_failures')
 
+BONUS_GROUPS = ['red', 'blue', 'green']
+EGG_MACHINES_FILE_NAME = 'egg_machines.json'
+
+# Snapshot cache stage -> the raw files it's parsed from
+STAGE_FILES = {
+    'raw_cards': [card.FILE_NAME],
+    'dungeons': [dungeon.FILE_NAME],
+    'bonus_sets': [bonus.FILE_NAME.format(g) for g in BONUS_GROUPS],
+    'skills': [skill.FILE_NAME],
+    'enemy_skills': [enemy_skill.FILE_NAME],
+    'extra': [exchange.FILE_NAME, EGG_MACHINES_FILE_NAME],
+}
+
+# Snapshot cache stage -> the stages it's computed from
+STAGE_DEPENDS_ON = {
+    'bonuses': ['bonus_sets', 'dungeons'],
+    'enemies': ['raw_cards', 'enemy_skills'],
+    'cards': ['raw_cards', 'skills', 'enemies'],
+}
+
 
 def _clean_bonuses(pg_server, bonus_sets, dungeons):
     dungeons_by_id = {d.dungeon_id: d for d in dungeons}
@@ -57,29 +80,87 @@ def _clean_cards(cards, skills, enemy_skills):
     return merged_cards
 
 
-def _clean_enemy(cards, enemy_skills):
-    enemy_skillset_lib.enemy_skill_map = {s.enemy_skill_id: s for s in enemy_skills}
+def _clean_enemy(cards, enemy_skill_registry):
     merged_enemies = []
     for card in cards:
         if len(card.enemy_skill_refs) == 0:
             continue
         enemy_skillset = [x for x in card.enemy_skill_refs]
-        behavior = enemy_skillset_lib.extract_behavior(card, enemy_skillset)
+        behavior = enemy_skillset_lib.extract_behavior(card, enemy_skillset, enemy_skill_registry)
         merged_enemies.append(MergedEnemy(card.card_id, behavior))
     return merged_enemies
 
 
+class _LazyField(object):
+    """A Database field that is built on first access.
+
+    This is a non-data descriptor: once a value is stored on the instance (by the
+    eager load, or by the first access here) it shadows the builder. Fields listed
+    in depends_on are the ones the builder reads; Database.invalidate uses them.
+    """
+
+    def __init__(self, builder_name: str, depends_on: List[str]=(), stage: str=None):
+        self.builder_name = builder_name
+        self.depends_on = depends_on
+        # The snapshot cache stage the value is stored under, if any
+        self.stage = stage
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance._build_lazy_field(self)
+        instance.__dict__[self.name] = value
+        return value
+
+
 class Database(object):
-    def __init__(self, pg_server, raw_dir):
+    # Builders for every loaded/computed field. The eager load_database() stores all of
+    # them up front; load_database(lazy=True) leaves each one to be built when first used.
+    raw_cards = _LazyField('_build_raw_cards', stage='raw_cards')
+    dungeons = _LazyField('_build_dungeons', stage='dungeons')
+    bonus_sets = _LazyField('_build_bonus_sets', stage='bonus_sets')
+    _skill_data = _LazyField('_build_skill_data', stage='skills')
+    skills = _LazyField('_build_skills', depends_on=['_skill_data'])
+    raw_skills = _LazyField('_build_raw_skills', depends_on=['_skill_data'])
+    enemy_skills = _LazyField('_build_enemy_skills', stage='enemy_skills')
+    enemy_skill_registry = _LazyField('_build_enemy_skill_registry', depends_on=['enemy_skills'])
+    _extra_data = _LazyField('_build_extra_data', stage='extra')
+    exchange = _LazyField('_build_exchange', depends_on=['_extra_data'])
+    egg_machines = _LazyField('_build_egg_machines', depends_on=['_extra_data'])
+    bonuses = _LazyField('_build_bonuses', depends_on=['bonus_sets', 'dungeons'], stage='bonuses')
+    enemies = _LazyField('_build_enemies', depends_on=['raw_cards', 'enemy_skills'], stage='enemies')
+    cards = _LazyField('_build_cards', depends_on=['raw_cards', 'skills', 'enemies'], stage='cards')
+    dungeon_id_to_dungeon = _LazyField('_build_dungeon_id_to_dungeon', depends_on=['dungeons'])
+    card_id_to_raw_card = _LazyField('_build_card_id_to_raw_card', depends_on=['raw_cards'])
+    enemy_id_to_enemy = _LazyField('_build_enemy_id_to_enemy', depends_on=['enemies'])
+
+    def __init__(self, pg_server, raw_dir, cache_dir=None):
         self.pg_server = pg_server
         self.base_dir = os.path.join(raw_dir, pg_server)
 
+        # If set, parsed/merged data is snapshotted here and reused while the raw files are unchanged
+        self.cache_dir = cache_dir
+        # Opened on the first lazily built field that's stored in the snapshot
+        self._snapshot = None
+        # Lazy fields being built right now; the snapshot is saved once the outermost one is done
+        self._snapshot_builds = 0
+
+        # Set by load_database; lazily built fields respect them too
+        self.skip_skills = False
+        self.skip_bonus = False
+        self.skip_extra = False
+
         # Loaded from disk
         self.raw_cards = []
         self.dungeons = []
         self.bonus_sets = {}
         self.skills = []
         self.enemy_skills = []
+        self.enemy_skill_registry = enemy_skillset_lib.EnemySkillRegistry([])
         self.exchange = []
         self.egg_machines = []
 
@@ -96,54 +177,222 @@ class Database(object):
         self.card_id_to_raw_card = {}
         self.enemy_id_to_enemy = {}
 
-    def load_database(self, skip_skills=False, skip_bonus=False, skip_extra=False):
+    def load_database(self, skip_skills=False, skip_bonus=False, skip_extra=False, lazy=False):
+        """Loads and merges the raw data.
+
+        With lazy=True nothing is read yet; each field is built from its dependencies
+        the first time it's accessed, so tools that only need e.g. dungeons don't pay
+        for the enemy/card merge. Lazily built fields still go through the snapshot
+        cache, which is written back whenever an access had to rebuild any of them.
+        """
+        self.skip_skills = skip_skills
+        self.skip_bonus = skip_bonus
+        self.skip_extra = skip_extra
+
+        if lazy:
+            for name in self._lazy_fields():
+                self.__dict__.pop(name, None)
+            self._snapshot = None
+            return
+
         base_dir = self.base_dir
-        self.raw_cards = card.load_card_data(data_dir=base_dir)
-        self.dungeons = dungeon.load_dungeon_data(data_dir=base_dir)
+        if self.cache_dir:
+            cache = SnapshotCache(self.cache_dir, base_dir, self.pg_server)
+        else:
+            cache = NullSnapshotCache()
+
+        self.raw_cards = cache.get('raw_cards', cache.files_key(STAGE_FILES['raw_cards']), self._build_raw_cards)
+        self.dungeons = cache.get('dungeons', cache.files_key(STAGE_FILES['dungeons']), self._build_dungeons)
 
         if not skip_bonus:
-            self.bonus_sets = {
-                'red': bonus.load_bonus_data(data_dir=base_dir, data_group='red'),
-                'blue': bonus.load_bonus_data(data_dir=base_dir, data_group='blue'),
-                'green': bonus.load_bonus_data(data_dir=base_dir, data_group='green'),
-            }
+            self.bonus_sets = cache.get('bonus_sets', cache.files_key(STAGE_FILES['bonus_sets']),
+                                        self._build_bonus_sets)
+        else:
+            cache.skip('bonus_sets')
 
         if not skip_skills:
-            self.skills = skill.load_skill_data(data_dir=base_dir)
-            self.raw_skills = skill.load_raw_skill_data(data_dir=base_dir)
-        self.enemy_skills = enemy_skill.load_enemy_skill_data(data_dir=base_dir)
+            self.skills, self.raw_skills = cache.get('skills', cache.files_key(STAGE_FILES['skills']),
+                                                     self._build_skill_data)
+        else:
+            cache.skip('skills')
+
+        self.enemy_skills = cache.get('enemy_skills', cache.files_key(STAGE_FILES['enemy_skills']),
+                                      self._build_enemy_skills)
 
         if not skip_extra:
-            self.exchange = exchange.load_data(data_dir=base_dir)
-            # TODO move this to egg machines parser same as others
-            with open(os.path.join(base_dir, 'egg_machines.json')) as f:
-                self.egg_machines = json.load(f)
-
-        self.bonuses = _clean_bonuses(self.pg_server, self.bonus_sets, self.dungeons)
-        self.enemies = _clean_enemy(self.raw_cards, self.enemy_skills)
-        self.cards = _clean_cards(self.raw_cards, self.skills, self.enemies)
-
-        self.dungeon_id_to_dungeon = {d.dungeon_id: d for d in self.dungeons}
-        self.card_id_to_raw_card = {c.card_id: c for c in self.raw_cards}
-        self.enemy_id_to_enemy = {e.enemy_id: e for e in self.enemies}
-
-    def save(self, output_dir: str, file_name: str, obj: object, pretty: bool):
-        output_file = os.path.join(output_dir, '{}_{}.json'.format(self.pg_server, file_name))
-        with open(output_file, 'w') as f:
-            if pretty:
-                json.dump(obj, f, indent=4, sort_keys=True, default=lambda x: x.__dict__)
-            else:
-                json.dump(obj, f, sort_keys=True, default=lambda x: x.__dict__)
-
-    def save_all(self, output_dir: str, pretty: bool):
-        self.save(output_dir, 'raw_cards', self.raw_cards, pretty)
-        self.save(output_dir, 'dungeons', self.dungeons, pretty)
-        self.save(output_dir, 'skills', self.skills, pretty)
-        self.save(output_dir, 'enemy_skills', self.enemy_skills, pretty)
-        self.save(output_dir, 'bonuses', self.bonuses, pretty)
-        self.save(output_dir, 'cards', self.cards, pretty)
-        self.save(output_dir, 'exchange', self.exchange, pretty)
-        self.save(output_dir, 'enemies', self.enemies, pretty)
+            self.exchange, self.egg_machines = cache.get('extra', cache.files_key(STAGE_FILES['extra']),
+                                                         self._build_extra_data)
+        else:
+            cache.skip('extra')
+
+        self.enemy_skill_registry = self._build_enemy_skill_registry()
+
+        self.bonuses = cache.get('bonuses', cache.stages_key(STAGE_DEPENDS_ON['bonuses']), self._build_bonuses)
+        self.enemies = cache.get('enemies', cache.stages_key(STAGE_DEPENDS_ON['enemies']), self._build_enemies)
+        self.cards = cache.get('cards', cache.stages_key(STAGE_DEPENDS_ON['cards']), self._build_cards)
+        cache.save()
+        if self.cache_dir:
+            # Fields invalidated later are rebuilt through the same snapshot
+            self._snapshot = cache
+
+        self.dungeon_id_to_dungeon = self._build_dungeon_id_to_dungeon()
+        self.card_id_to_raw_card = self._build_card_id_to_raw_card()
+        self.enemy_id_to_enemy = self._build_enemy_id_to_enemy()
+
+    def __getstate__(self):
+        # The open snapshot is reread on demand rather than pickled with every field
+        state = dict(self.__dict__)
+        state['_snapshot'] = None
+        state['_snapshot_builds'] = 0
+        return state
+
+    def snapshot_is_warm(self) -> bool:
+        """Whether every stage can be restored from the snapshot without parsing anything."""
+        if not self.cache_dir:
+            return False
+        cache = self._open_snapshot()
+        for stage in list(STAGE_FILES) + list(STAGE_DEPENDS_ON):
+            key = self._stage_key(cache, stage)
+            if key != SKIPPED_KEY and cache.stages.get(stage, (None,))[0] != key:
+                return False
+        return True
+
+    def _open_snapshot(self) -> SnapshotCache:
+        if self._snapshot is None:
+            self._snapshot = SnapshotCache(self.cache_dir, self.base_dir, self.pg_server)
+        return self._snapshot
+
+    def _build_lazy_field(self, field: _LazyField):
+        builder = getattr(self, field.builder_name)
+        if not self.cache_dir or field.stage is None:
+            return builder()
+        cache = self._open_snapshot()
+        key = self._stage_key(cache, field.stage)
+        if key == SKIPPED_KEY:
+            return builder()
+
+        misses = len(cache.misses)
+        self._snapshot_builds += 1
+        try:
+            value = cache.get(field.stage, key, builder)
+        finally:
+            self._snapshot_builds -= 1
+        if not self._snapshot_builds and len(cache.misses) > misses:
+            cache.save()
+        return value
+
+    def _stage_key(self, cache: SnapshotCache, stage: str) -> str:
+        # Recomputed on every lookup, so a field invalidated after its raw files changed isn't
+        # restored from the old snapshot; unchanged files aren't rehashed.
+        if stage in STAGE_DEPENDS_ON:
+            for dep in STAGE_DEPENDS_ON[stage]:
+                self._stage_key(cache, dep)
+            key = cache.stages_key(STAGE_DEPENDS_ON[stage])
+        elif ((stage == 'bonus_sets' and self.skip_bonus) or
+              (stage == 'skills' and self.skip_skills) or
+              (stage == 'extra' and self.skip_extra)):
+            key = SKIPPED_KEY
+        else:
+            key = cache.files_key(STAGE_FILES[stage])
+        cache.keys[stage] = key
+        return key
+
+    @classmethod
+    def _lazy_fields(cls) -> Dict[str, _LazyField]:
+        return {k: v for k, v in vars(cls).items() if isinstance(v, _LazyField)}
+
+    def invalidate(self, *field_names):
+        """Drops the named fields and everything derived from them.
+
+        They are rebuilt from their dependencies the next time they're accessed.
+        """
+        lazy_fields = self._lazy_fields()
+        pending = list(field_names)
+        while pending:
+            name = pending.pop()
+            self.__dict__.pop(name, None)
+            pending.extend(k for k, v in lazy_fields.items() if name in v.depends_on)
+
+    def _build_raw_cards(self):
+        return card.load_card_data(data_dir=self.base_dir)
+
+    def _build_dungeons(self):
+        return dungeon.load_dungeon_data(data_dir=self.base_dir)
+
+    def _build_bonus_sets(self):
+        if self.skip_bonus:
+            return {}
+        return {g: bonus.load_bonus_data(data_dir=self.base_dir, data_group=g) for g in BONUS_GROUPS}
+
+    def _build_skill_data(self):
+        if self.skip_skills:
+            return [], []
+        return skill.load_skill_data_and_raw(data_dir=self.base_dir)
+
+    def _build_skills(self):
+        return self._skill_data[0]
+
+    def _build_raw_skills(self):
+        return self._skill_data[1]
+
+    def _build_enemy_skills(self):
+        return enemy_skill.load_enemy_skill_data(data_dir=self.base_dir)
+
+    def _build_enemy_skill_registry(self):
+        return enemy_skillset_lib.EnemySkillRegistry(self.enemy_skills)
+
+    def _build_extra_data(self):
+        if self.skip_extra:
+            return [], []
+        exchange_data = exchange.load_data(data_dir=self.base_dir)
+        # TODO move this to egg machines parser same as others
+        with open(os.path.join(self.base_dir, EGG_MACHINES_FILE_NAME)) as f:
+            return exchange_data, json.load(f)
+
+    def _build_exchange(self):
+        return self._extra_data[0]
+
+    def _build_egg_machines(self):
+        return self._extra_data[1]
+
+    def _build_bonuses(self):
+        return _clean_bonuses(self.pg_server, self.bonus_sets, self.dungeons)
+
+    def _build_enemies(self):
+        return _clean_enemy(self.raw_cards, self.enemy_skill_registry)
+
+    def _build_cards(self):
+        return _clean_cards(self.raw_cards, self.skills, self.enemies)
+
+    def _build_dungeon_id_to_dungeon(self):
+        return {d.dungeon_id: d for d in self.dungeons}
+
+    def _build_card_id_to_raw_card(self):
+        return {c.card_id: c for c in self.raw_cards}
+
+    def _build_enemy_id_to_enemy(self):
+        return {e.enemy_id: e for e in self.enemies}
+
+    def save(self, output_dir: str, file_name: str, obj: object, pretty: bool, compression: str=None):
+        output_file = intermediate.output_file_name(
+            output_dir, '{}_{}'.format(self.pg_server, file_name), compression)
+        intermediate.write_json(output_file, obj, pretty, compression)
+
+    def save_all(self, output_dir: str, pretty: bool, compression: str=None, workers: int=None):
+        """Writes every collection to output_dir; see intermediate.write_all for compression/workers."""
+        files = [
+            ('raw_cards', self.raw_cards),
+            ('dungeons', self.dungeons),
+            ('skills', self.skills),
+            ('enemy_skills', self.enemy_skills),
+            ('bonuses', self.bonuses),
+            ('cards', self.cards),
+            ('exchange', self.exchange),
+            ('enemies', self.enemies),
+        ]
+        intermediate.write_all(output_dir,
+                               [('{}_{}'.format(self.pg_server, name), obj) for name, obj in files],
+                               pretty, compression=compression, workers=workers)
 
     def dungeon_by_id(self, dungeon_id):
         return self.dungeon_id_to_dungeon.get(dungeon_id, None)
@@ -152,4 +401,68 @@ class Database(object):
         return self.card_id_to_raw_card.get(card_id, None)
 
     def enemy_by_id(self, enemy_id):
-        return self.enemy_id_to_enemy.get(enemy_id, None)
\ No newline at end of file
+        return self.enemy_id_to_enemy.get(enemy_id, None)
+
+
+def _load_server(pg_server: str, raw_dir: str, cache_dir: str, load_kwargs: dict) -> Database:
+    db = Database(pg_server, raw_dir, cache_dir=cache_dir)
+    db.load_database(**load_kwargs)
+    return db
+
+
+class SnapshotWritten(object):
+    """What a load_all_servers worker hands back: which server's snapshot it wrote.
+
+    The Database itself stays in the worker; the parent restores it from the snapshot.
+    """
+
+    def __init__(self, pg_server: str):
+        self.pg_server = pg_server
+
+
+def _write_snapshot(pg_server: str, raw_dir: str, cache_dir: str, load_kwargs: dict) -> SnapshotWritten:
+    _load_server(pg_server, raw_dir, cache_dir, load_kwargs)
+    return SnapshotWritten(pg_server)
+
+
+def _open_server(pg_server: str, raw_dir: str, cache_dir: str, load_kwargs: dict) -> Database:
+    db = Database(pg_server, raw_dir, cache_dir=cache_dir)
+    db.load_database(**dict(load_kwargs, lazy=True))
+    return db
+
+
+def load_all_servers(servers: List[str], raw_dir: str, workers: int=None,
+                     cache_dir: str=None, **load_kwargs) -> Dict[str, Database]:
+    """Loads a Database for each server.
+
+    Without a cache_dir the servers are loaded in-process, in order; a worker would
+    have to pickle its Database back, which costs about as much as parsing it here.
+
+    With a cache_dir, servers whose snapshot is already up to date are opened lazily
+    and every field is restored from the snapshot when first used. The rest are
+    parsed in parallel, up to workers at once: one in this process, the others in a
+    process pool where each worker only writes its server's snapshot (see
+    SnapshotWritten). Those servers are then restored from the new snapshot here, so
+    nothing is parsed twice.
+    """
+    if workers is None:
+        workers = min(len(servers), os.cpu_count() or 1)
+
+    if not cache_dir:
+        return {s: _load_server(s, raw_dir, cache_dir, load_kwargs) for s in servers}
+
+    results = {s: _open_server(s, raw_dir, cache_dir, load_kwargs) for s in servers}
+    stale = [s for s in servers if not results[s].snapshot_is_warm()]
+    if workers <= 1 or len(stale) <= 1:
+        for s in stale:
+            results[s] = _load_server(s, raw_dir, cache_dir, load_kwargs)
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(stale)) - 1) as executor:
+        futures = [executor.submit(_write_snapshot, s, raw_dir, cache_dir, load_kwargs) for s in stale[1:]]
+        results[stale[0]] = _load_server(stale[0], raw_dir, cache_dir, load_kwargs)
+        for f in futures:
+            written = f.result()
+            results[written.pg_server] = _open_server(written.pg_server, raw_dir, cache_dir, load_kwargs)
+
+    return results
@@ -2,8 +2,6 @@
 Parses Dungeon and DungeonFloor data.
 """
 
-import csv
-from io import StringIO
 import json
 import os
 from typing import List, Any
@@ -12,6 +10,7 @@ from ..common import pad_util
 from ..common.dungeon_types import DUNGEON_TYPE, REPEAT_DAY
 from ..common.dungeon_parse import getModifiers
 from ..common.dungeon_maps import raw7_map
+from .tokenizer import split_prefixed_lines
 
 # The typical JSON file name for this data.
 FILE_NAME = 'download_dungeon_data.json'
@@ -221,10 +220,7 @@ def load_dungeon_data(data_dir: str = None, dungeon_file: str = None) -> List[Du
     dungeons = []
     cur_dungeon = None
 
-    for line in dungeon_info.split('\n'):
-        info = line[0:2]
-        data = line[2:]
-        data_values = next(csv.reader(StringIO(data), quotechar="'"))
+    for info, data_values, line in split_prefixed_lines(dungeon_info, quotechar="'"):
         if info == 'd;':
             cur_dungeon = Dungeon(data_values)
             dungeons.append(cur_dungeon)
@@ -1,10 +1,9 @@
-import csv
-from io import StringIO
 import json
 import os
 from typing import List, Any
 
 from ..common import pad_util
+from .tokenizer import split_enemy_skill_lines
 
 FILE_NAME = 'download_enemy_skill_data.json'
 
@@ -12,7 +11,6 @@ FILE_NAME = 'download_enemy_skill_data.json'
 class EnemySkill(pad_util.JsonDictEncodable):
 
     def __init__(self, raw: List[Any]):
-        from builtins import int
         self.enemy_skill_id = int(raw[0])
         self.name = raw[1]
         self.type = int(raw[2])
@@ -33,7 +31,4 @@ def load_enemy_skill_data(data_dir: str=None, card_json_file: str=None) -> List[
         card_json_file = os.path.join(data_dir, FILE_NAME)
     with open(card_json_file) as f:
         enemy_skill_json = json.load(f)
-    es = enemy_skill_json['enemy_skills']
-    es = es.replace("',", "#,").replace(",'", ",#").replace("'\n", "#\n")
-    csv_lines = csv.reader(StringIO(es), quotechar="#", delimiter=',')
-    return [EnemySkill(x) for x in csv_lines if x[0] != 'c']
+    return [EnemySkill(x) for x in split_enemy_skill_lines(enemy_skill_json['enemy_skills'])]
@@ -0,0 +1,156 @@
+"""
+Writes the intermediate JSON dumps of the parsed/merged data.
+
+The output is byte-for-byte what `json.dump(obj, f, sort_keys=True,
+default=lambda x: x.__dict__)` (plus indent=4 when pretty) produces, but:
+
+  * json.dump always goes through the pure-python encoder; here each record of
+    a top-level list is encoded separately with json.dumps (which uses the C
+    encoder when not pretty) and streamed to the file, so the whole document is
+    never held in memory as one string.
+  * objects are converted by a per-class encoder built on first use instead of
+    the generic __dict__ lambda; slotted classes read all their fields with a
+    single attrgetter rather than the synthesized __dict__ property.
+  * several files are written at once on a thread pool, and can be compressed
+    with gzip or zstd (zstd requires the optional zstandard package).
+"""
+
+import gzip
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from typing import Any, Callable, List, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# Number of encoded records buffered before each write.
+_WRITE_BATCH = 256
+
+_PRETTY_INDENT = 4
+_PRETTY_NEWLINE = '\n' + ' ' * _PRETTY_INDENT
+
+
+def _make_encoder(cls) -> Callable[[Any], Any]:
+    slot_names = getattr(cls, '_slot_names', None)
+    if not slot_names:
+        return attrgetter('__dict__')
+
+    if len(slot_names) == 1:
+        name = slot_names[0]
+        getter = lambda o: (getattr(o, name),)
+    else:
+        getter = attrgetter(*slot_names)
+
+    def encode(o):
+        try:
+            return dict(zip(slot_names, getter(o)))
+        except AttributeError:
+            # Some slot was never assigned; the synthesized __dict__ leaves it out.
+            return o.__dict__
+
+    return encode
+
+
+class ClassEncoders(dict):
+    """Maps a class to the function that converts its instances into JSON-able values.
+
+    Instances are callable so that they can be passed as json's `default`.
+    """
+
+    def __missing__(self, cls):
+        encoder = _make_encoder(cls)
+        self[cls] = encoder
+        return encoder
+
+    def __call__(self, o):
+        return self[type(o)](o)
+
+
+def _open_output(output_file: str, compression: str):
+    if compression is None:
+        return open(output_file, 'w')
+    elif compression == 'gzip':
+        return gzip.open(output_file, 'wt')
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        raw = open(output_file, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw))
+    else:
+        raise ValueError('unknown compression: {}'.format(compression))
+
+
+def output_file_name(output_dir: str, file_name: str, compression: str=None) -> str:
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError('unknown compression: {}'.format(compression))
+    return os.path.join(output_dir, '{}.json{}'.format(file_name, COMPRESSION_SUFFIXES[compression]))
+
+
+def write_json(output_file: str, obj: Any, pretty: bool, compression: str=None, encoders: ClassEncoders=None):
+    """Dumps obj to output_file, streaming the elements if obj is a list."""
+    encoders = encoders if encoders is not None else ClassEncoders()
+    if pretty:
+        def dumps(o):
+            return json.dumps(o, indent=_PRETTY_INDENT, sort_keys=True, default=encoders)
+
+        def dumps_element(o):
+            # Elements sit one level deep in the list; json escapes newlines inside strings.
+            return dumps(o).replace('\n', _PRETTY_NEWLINE)
+    else:
+        def dumps(o):
+            return json.dumps(o, sort_keys=True, default=encoders)
+
+        dumps_element = dumps
+
+    with _open_output(output_file, compression) as f:
+        if not isinstance(obj, list) or not obj:
+            f.write(dumps(obj))
+            return
+
+        if pretty:
+            f.write('[' + _PRETTY_NEWLINE)
+            separator = ',' + _PRETTY_NEWLINE
+        else:
+            f.write('[')
+            separator = ', '
+
+        for start in range(0, len(obj), _WRITE_BATCH):
+            if start:
+                f.write(separator)
+            f.write(separator.join([dumps_element(o) for o in obj[start:start + _WRITE_BATCH]]))
+
+        f.write('\n]' if pretty else ']')
+
+
+def write_all(output_dir: str, files: List[Tuple[str, Any]], pretty: bool,
+              compression: str=None, workers: int=None) -> List[str]:
+    """Writes each (file_name, obj) pair concurrently, returning the paths written.
+
+    Threads are used rather than processes since the objects would otherwise have to
+    be pickled across; compression and file IO release the GIL.
+    """
+    encoders = ClassEncoders()
+    output_files = [output_file_name(output_dir, name, compression) for name, _ in files]
+
+    if workers is not None and workers <= 1:
+        for output_file, (_, obj) in zip(output_files, files):
+            write_json(output_file, obj, pretty, compression, encoders)
+        return output_files
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_json, output_file, obj, pretty, compression, encoders)
+                   for output_file, (_, obj) in zip(output_files, files)]
+        for future in futures:
+            future.result()
+    return output_files
@@ -0,0 +1,155 @@
+"""
+Computes what changed between two raw data pulls for a server.
+
+Records are matched up by ID and compared in their raw form first (plain list
+and string comparisons), so only the records that actually differ get parsed.
+Those are then compared field by field on the parsed objects to report which
+fields changed.
+"""
+
+import json
+import os
+from typing import Any, Callable, Dict, List, Tuple
+
+from ..common import pad_util
+from . import card, dungeon, enemy_skill, exchange, skill
+from .intermediate import ClassEncoders
+from .tokenizer import split_enemy_skill_lines, split_prefixed_lines
+
+
+class EntityDelta(pad_util.JsonDictEncodable):
+    """Changes to one kind of entity, by ID."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.added = []  # type: List[int]
+        self.removed = []  # type: List[int]
+        # ID -> names of the fields that differ
+        self.modified = {}  # type: Dict[int, List[str]]
+
+    def changed_ids(self) -> List[int]:
+        """IDs that are new or modified; the ones downstream stages need to reprocess."""
+        return sorted(self.added + list(self.modified.keys()))
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.modified)
+
+    def __repr__(self):
+        return 'EntityDelta({} - +{} -{} ~{})'.format(
+            self.kind, len(self.added), len(self.removed), len(self.modified))
+
+
+class ChangeSet(pad_util.JsonDictEncodable):
+    """Every EntityDelta for a server between two pulls."""
+
+    def __init__(self, server: str):
+        self.server = server
+        self.deltas = {}  # type: Dict[str, EntityDelta]
+
+    def delta(self, kind: str) -> EntityDelta:
+        return self.deltas[kind]
+
+    def is_empty(self) -> bool:
+        return all(d.is_empty() for d in self.deltas.values())
+
+    def save(self, output_file: str):
+        with open(output_file, 'w') as f:
+            json.dump(self, f, indent=4, sort_keys=True, default=lambda x: x.__dict__)
+
+    def __repr__(self):
+        return 'ChangeSet({} - {})'.format(self.server, list(self.deltas.values()))
+
+
+def _card_records(raw: Any) -> Dict[int, Any]:
+    return {int(r[0]): r for r in raw['card']}
+
+
+def _skill_records(raw: Any) -> Dict[int, Any]:
+    return dict(enumerate(raw['skill']))
+
+
+def _enemy_skill_records(raw: Any) -> Dict[int, Any]:
+    return {int(r[0]): r for r in split_enemy_skill_lines(raw['enemy_skills'])}
+
+
+def _dungeon_records(raw: Any) -> Dict[int, Any]:
+    # A dungeon record is its `d;` line plus the `f;` lines that follow it.
+    records = {}
+    cur_lines = None
+    for info, data_values, _ in split_prefixed_lines(raw['dungeons'], quotechar="'"):
+        if info == 'd;':
+            cur_lines = [data_values]
+            records[int(data_values[0])] = cur_lines
+        elif info == 'f;':
+            cur_lines.append(data_values)
+    return records
+
+
+def _parse_dungeon(lines: List[List[str]]) -> dungeon.Dungeon:
+    result = dungeon.Dungeon(lines[0])
+    result.floors.extend(dungeon.DungeonFloor(f) for f in lines[1:])
+    return result
+
+
+def _exchange_records(raw: Any) -> Dict[int, Any]:
+    rows = [item.split(',') for item in raw['d'].split('\n')]
+    return {int(r[1]): r for r in rows}
+
+
+# kind -> (raw file name, raw json -> {id: raw record}, (id, raw record, server) -> parsed object)
+_KINDS = [
+    ('cards', card.FILE_NAME, _card_records, lambda i, r, s: card.BookCard(r)),
+    ('skills', skill.FILE_NAME, _skill_records, lambda i, r, s: skill.MonsterSkill(i, r)),
+    ('enemy_skills', enemy_skill.FILE_NAME, _enemy_skill_records, lambda i, r, s: enemy_skill.EnemySkill(r)),
+    ('dungeons', dungeon.FILE_NAME, _dungeon_records, lambda i, r, s: _parse_dungeon(r)),
+    ('exchange', exchange.FILE_NAME, _exchange_records, lambda i, r, s: exchange.Exchange(r, s)),
+]  # type: List[Tuple[str, str, Callable[[Any], Dict[int, Any]], Callable[[int, Any, str], Any]]]
+
+
+def _load_records(data_dir: str, file_name: str, records_fn) -> Dict[int, Any]:
+    json_file = os.path.join(data_dir, file_name)
+    if not os.path.exists(json_file):
+        return {}
+    with open(json_file) as f:
+        return records_fn(json.load(f))
+
+
+def _changed_fields(old_obj: Any, new_obj: Any, encoders: ClassEncoders) -> List[str]:
+    # Round trip through json so that nested objects (floors, curves, etc) compare by value.
+    old_fields = json.loads(json.dumps(old_obj, default=encoders))
+    new_fields = json.loads(json.dumps(new_obj, default=encoders))
+    names = set(old_fields.keys()) | set(new_fields.keys())
+    return sorted(n for n in names if old_fields.get(n) != new_fields.get(n))
+
+
+def diff_records(kind: str, old_records: Dict[int, Any], new_records: Dict[int, Any],
+                 parse_fn: Callable[[int, Any], Any]) -> EntityDelta:
+    """Diffs two {id: raw record} maps, parsing only the records that differ."""
+    delta = EntityDelta(kind)
+    delta.added = sorted(set(new_records.keys()) - set(old_records.keys()))
+    delta.removed = sorted(set(old_records.keys()) - set(new_records.keys()))
+
+    encoders = ClassEncoders()
+    for record_id, new_record in new_records.items():
+        old_record = old_records.get(record_id)
+        if old_record is None or old_record == new_record:
+            continue
+        fields = _changed_fields(parse_fn(record_id, old_record), parse_fn(record_id, new_record), encoders)
+        if fields:
+            delta.modified[record_id] = fields
+
+    return delta
+
+
+def compute_change_set(old_dir: str, new_dir: str, server: str) -> ChangeSet:
+    """Compares the raw files of two pulls for the same server.
+
+    A file missing from old_dir (e.g. the first pull) reports all its records as added.
+    """
+    change_set = ChangeSet(server)
+    for kind, file_name, records_fn, parse_fn in _KINDS:
+        old_records = _load_records(old_dir, file_name, records_fn)
+        new_records = _load_records(new_dir, file_name, records_fn)
+        change_set.deltas[kind] = diff_records(
+            kind, old_records, new_records, lambda i, r: parse_fn(i, r, server))
+    return change_set
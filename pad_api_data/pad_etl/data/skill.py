@@ -4,7 +4,7 @@ Parses monster skill (leader/active) data.
 
 import json
 import os
-from typing import List, Any
+from typing import List, Any, Tuple
 
 from ..common import pad_util
 from ..common.shared_types import SkillId
@@ -84,16 +84,8 @@ class MonsterSkill(pad_util.JsonDictEncodable):
 
 def load_skill_data(data_dir=None, skill_json_file: str = None) -> List[MonsterSkill]:
     """Load MonsterSkill objects from the PAD json file."""
-    if skill_json_file is None:
-        skill_json_file = os.path.join(data_dir, FILE_NAME)
-
-    with open(skill_json_file) as f:
-        skill_json = json.load(f)
-
-    if skill_json['v'] > 1220:
-        print('Warning! Version of skill file is not tested: {}'.format(skill_json['v']))
-
-    return [MonsterSkill(i, ms) for i, ms in enumerate(skill_json['skill'])]
+    skills, _ = load_skill_data_and_raw(data_dir, skill_json_file)
+    return skills
 
 
 def load_raw_skill_data(data_dir=None, skill_json_file: str = None) -> object:
@@ -103,6 +95,14 @@ def load_raw_skill_data(data_dir=None, skill_json_file: str = None) -> object:
         skill_json_file = os.path.join(data_dir, FILE_NAME)
 
     with open(skill_json_file) as f:
-        skill_json = json.load(f)
+        return json.load(f)
+
+
+def load_skill_data_and_raw(data_dir=None, skill_json_file: str = None) -> Tuple[List[MonsterSkill], object]:
+    """Load MonsterSkill objects and the raw PAD json they came from with a single decode."""
+    skill_json = load_raw_skill_data(data_dir, skill_json_file)
+
+    if skill_json['v'] > 1220:
+        print('Warning! Version of skill file is not tested: {}'.format(skill_json['v']))
 
-    return skill_json
+    return [MonsterSkill(i, ms) for i, ms in enumerate(skill_json['skill'])], skill_json
@@ -0,0 +1,156 @@
+"""
+Caches the parsed and merged output of Database.load_database on disk.
+
+Each raw input file is identified by the sha1 of its contents; the file size
+and mtime are recorded alongside so that unchanged files don't need to be
+rehashed on every run. Every load stage is stored with a key derived from the
+files (or other stages) it depends on, so when a single raw file changes only
+the stages downstream of it are rebuilt.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger('processor')
+
+# Bump this whenever the parsing/merging code changes in a way that should
+# invalidate existing snapshots.
+CACHE_VERSION = 2
+
+# Stage key used for stages that were skipped via the load_database flags.
+SKIPPED_KEY = 'skipped'
+
+
+def _hash_file(file_path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _hash_values(values: List[Any]) -> str:
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+class SnapshotCache(object):
+    """A single pickled snapshot of every load stage for one server.
+
+    All the stages are stored in one pickle so that object identity is kept
+    between them (e.g. MergedCard.card is the same object as in raw_cards).
+    """
+
+    def __init__(self, cache_dir: str, base_dir: str, name: str):
+        self.cache_file = os.path.join(cache_dir, '{}_snapshot.pickle'.format(name))
+        self.base_dir = base_dir
+
+        # file name -> (size, mtime_ns, sha1)
+        self.files = {}  # type: Dict[str, tuple]
+        # stage name -> (key, value)
+        self.stages = {}  # type: Dict[str, tuple]
+        # stage name -> key, for every stage requested during this run
+        self.keys = {}  # type: Dict[str, str]
+
+        self.hits = []  # type: List[str]
+        self.misses = []  # type: List[str]
+
+        self._read()
+
+    def _read(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception as ex:
+            logger.warning('Failed to read snapshot %s: %s', self.cache_file, ex)
+            return
+
+        if snapshot.get('version') != CACHE_VERSION:
+            logger.info('Discarding snapshot %s with old version', self.cache_file)
+            return
+
+        self.files = snapshot['files']
+        self.stages = snapshot['stages']
+
+    def file_hash(self, file_name: str) -> str:
+        """Returns the content hash of a raw file, rehashing only if the file was touched."""
+        file_path = os.path.join(self.base_dir, file_name)
+        if not os.path.exists(file_path):
+            return None
+
+        stat = os.stat(file_path)
+        cached = self.files.get(file_name)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        file_hash = _hash_file(file_path)
+        self.files[file_name] = (stat.st_size, stat.st_mtime_ns, file_hash)
+        return file_hash
+
+    def files_key(self, file_names: List[str], *extra) -> str:
+        """Key for a stage parsed directly from raw files."""
+        return _hash_values([(f, self.file_hash(f)) for f in file_names] + list(extra))
+
+    def stages_key(self, stage_names: List[str]) -> str:
+        """Key for a stage computed from other stages loaded during this run."""
+        return _hash_values([(s, self.keys[s]) for s in stage_names])
+
+    def skip(self, stage: str):
+        """Marks a stage as skipped for this run; stages depending on it get a distinct key."""
+        self.keys[stage] = SKIPPED_KEY
+
+    def get(self, stage: str, key: str, build_fn: Callable[[], Any]) -> Any:
+        """Returns the stored value for stage if the key matches, otherwise rebuilds it."""
+        self.keys[stage] = key
+        cached = self.stages.get(stage)
+        if cached and cached[0] == key:
+            self.hits.append(stage)
+            return cached[1]
+
+        self.misses.append(stage)
+        value = build_fn()
+        self.stages[stage] = (key, value)
+        return value
+
+    def save(self):
+        """Writes the snapshot back to disk, if anything had to be rebuilt."""
+        if not self.misses:
+            logger.info('Reused all stages from snapshot %s', self.cache_file)
+            return
+
+        logger.info('Rebuilt stages %s, saving snapshot %s', self.misses, self.cache_file)
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        snapshot = {
+            'version': CACHE_VERSION,
+            'files': self.files,
+            # Stages not requested this run (e.g. skipped) are kept as they were read, in the
+            # same pickle as the rest so object identity between stages still holds
+            'stages': self.stages,
+        }
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.cache_file)
+
+
+class NullSnapshotCache(object):
+    """Stand-in used when caching is disabled; always builds and never hashes."""
+
+    def files_key(self, file_names: List[str], *extra) -> str:
+        return None
+
+    def stages_key(self, stage_names: List[str]) -> str:
+        return None
+
+    def skip(self, stage: str):
+        pass
+
+    def get(self, stage: str, key: str, build_fn: Callable[[], Any]) -> Any:
+        return build_fn()
+
+    def save(self):
+        pass
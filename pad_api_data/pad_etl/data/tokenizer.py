@@ -0,0 +1,64 @@
+"""
+Tokenizers for the CSV-like text blobs embedded in some PAD JSON files.
+
+The dungeon file is a newline separated list of `d;`/`f;`/`c;` prefixed CSV
+lines, and the enemy skill file is CSV where an apostrophe only acts as a quote
+when it sits on a field boundary. Both are tokenized here with a single
+csv.reader over the whole blob instead of one reader per line.
+"""
+
+import csv
+from io import StringIO
+from itertools import islice
+from typing import Iterator, List, Tuple
+
+
+def _split_single_line(data: str, quotechar: str) -> List[str]:
+    return next(csv.reader(StringIO(data), quotechar=quotechar))
+
+
+def split_prefixed_lines(blob: str, quotechar: str = "'") -> Iterator[Tuple[str, List[str], str]]:
+    """Yields (prefix, fields, line) for each line of a blob like `d;1,'name',...`.
+
+    line is the raw, untokenized line. Every line is tokenized on its own,
+    exactly as if it had been given to a fresh csv.reader. A quoted field never
+    runs onto the next line; if one is left open (or a stray carriage return
+    upsets the shared reader) that line is re-read on its own and tokenizing
+    resumes after it.
+    """
+    lines = blob.split('\n')
+    start = 0
+    while start < len(lines):
+        reader = csv.reader((line[2:] for line in islice(lines, start, None)), quotechar=quotechar)
+        idx = start
+        resync = False
+        try:
+            for fields in reader:
+                line = lines[idx]
+                if reader.line_num != idx - start + 1:
+                    resync = True
+                    break
+                yield line[:2], fields, line
+                idx += 1
+        except csv.Error:
+            resync = True
+
+        if not resync:
+            break
+        line = lines[idx]
+        yield line[:2], _split_single_line(line[2:], quotechar), line
+        start = idx + 1
+
+
+def split_enemy_skill_lines(blob: str) -> Iterator[List[str]]:
+    """Yields the fields of each enemy skill row, skipping the trailing 'c' checksum row.
+
+    Apostrophes next to a comma or a newline are the real quotes, so they are
+    swapped for '#' and that is used as the quote character. The swap is three
+    str.replace calls; they run at memchr speed and measured faster than a
+    single regex substitution or a hand-written tokenizer.
+    """
+    blob = blob.replace("',", "#,").replace(",'", ",#").replace("'\n", "#\n")
+    for fields in csv.reader(StringIO(blob), quotechar='#', delimiter=','):
+        if fields[0] != 'c':
+            yield fields
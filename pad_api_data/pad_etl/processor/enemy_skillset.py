@@ -1,7 +1,7 @@
 from collections import OrderedDict
 import json
 from math import ceil, log
-from typing import List
+from typing import Iterable, List
 
 from ..data.card import EnemySkillRef, BookCard
 
@@ -40,8 +40,43 @@ class DictWithAttributeAccess(dict):
         self[key] = value
 
 
-# TODO: this needs fixing, can't have a global map like this
-enemy_skill_map = None
+class EnemySkillRegistry(object):
+    """The enemy skills for one server, by enemy_skill_id.
+
+    Behaviors are built from refs resolved here, which carry their skill's
+    name/params/type, so servers with different skill data can be processed
+    side by side.
+    """
+
+    def __init__(self, enemy_skills: Iterable):
+        self.skills = {s.enemy_skill_id: s for s in enemy_skills}
+
+    def get(self, enemy_skill_id: int):
+        return self.skills[enemy_skill_id]
+
+    def resolve(self, skill: EnemySkillRef) -> 'ResolvedSkillRef':
+        return ResolvedSkillRef(skill, self)
+
+
+class ResolvedSkillRef(object):
+    """An EnemySkillRef along with the enemy skill it refers to; the ES* classes are built from these."""
+
+    __slots__ = ('enemy_skill_id', 'enemy_ai', 'enemy_rnd', 'enemy_skill', 'registry')
+
+    def __init__(self, skill: EnemySkillRef, registry: EnemySkillRegistry):
+        self.enemy_skill_id = skill.enemy_skill_id
+        self.enemy_ai = skill.enemy_ai
+        self.enemy_rnd = skill.enemy_rnd
+        self.enemy_skill = registry.get(skill.enemy_skill_id)
+        # Skill sets resolve their sub-skills against the same server's skills
+        self.registry = registry
+
+
+def _enemy_skill(skill: EnemySkillRef):
+    if not isinstance(skill, ResolvedSkillRef):
+        raise ValueError('enemy skill {} was not resolved through an EnemySkillRegistry; '
+                         'use EnemySkillRegistry.resolve or extract_behavior'.format(skill.enemy_skill_id))
+    return skill.enemy_skill
 
 
 def es_id(skill: EnemySkillRef):
@@ -49,11 +84,11 @@ def es_id(skill: EnemySkillRef):
 
 
 def name(skill: EnemySkillRef):
-    return enemy_skill_map[skill.enemy_skill_id].name
+    return _enemy_skill(skill).name
 
 
 def params(skill: EnemySkillRef):
-    return enemy_skill_map[skill.enemy_skill_id].params
+    return _enemy_skill(skill).params
 
 
 def ai(skill: EnemySkillRef):
@@ -65,7 +100,7 @@ def rnd(skill: EnemySkillRef):
 
 
 def es_type(skill: EnemySkillRef):
-    return enemy_skill_map[skill.enemy_skill_id].type
+    return _enemy_skill(skill).type
 
 
 def attribute_bitmap(bits, inverse=False, bit_len=9):
@@ -480,7 +515,7 @@ class ESBehavior(object):
 # Action
 class ESAction(ESBehavior):
     def full_description(self):
-        if self.description == 'Enemy action':
+        if self.description == 'Enemy action' and self.attack:
             return self.attack.description
         else:
             output = self.description
@@ -543,8 +578,8 @@ class ESDefaultAttack(ESAttackSinglehit):
     Implies that a monster uses its normal attack.
     """
 
-    def __init__(self):
-        super().__init__(EnemySkillRef(1, 100, 0))
+    def __init__(self, registry: EnemySkillRegistry):
+        super().__init__(registry.resolve(EnemySkillRef(1, 100, 0)))
         self.name = 'Default Attack'
 
 
@@ -1273,9 +1308,9 @@ class ESBoardChangeAttackBits(ESBoardChange):
 
 
 class SubSkill(object):
-    def __init__(self, enemy_skill_id):
+    def __init__(self, enemy_skill_id, registry: EnemySkillRegistry):
         self.enemy_skill_id = enemy_skill_id
-        self.enemy_skill_info = enemy_skill_map[enemy_skill_id]
+        self.enemy_skill_info = registry.get(enemy_skill_id)
         self.enemy_ai = None
         self.enemy_rnd = None
 
@@ -1286,7 +1321,7 @@ class ESSkillSet(ESAction):
         i = 0
         for s in params(skill)[1:11]:
             if s is not None:
-                sub_skill = EnemySkillRef(s, 0, 0)
+                sub_skill = skill.registry.resolve(EnemySkillRef(s, 0, 0))
                 if es_type(sub_skill) in BEHAVIOR_MAP:
                     behavior = BEHAVIOR_MAP[es_type(sub_skill)](sub_skill)
                     self.skill_list.append(behavior)
@@ -1675,8 +1710,8 @@ class ESCountdown(ESLogic):
 
 class ESCountdownMessage(ESAction):
     """Dummy action class to represent displaying countdown numbers"""
-    def __init__(self, enemy_skill_id, current_counter=0):
-        super(ESCountdownMessage, self).__init__(EnemySkillRef(enemy_skill_id, 0, 0))
+    def __init__(self, skill: EnemySkillRef, current_counter=0):
+        super(ESCountdownMessage, self).__init__(skill)
         self.enemy_skill_id += 1000 * current_counter
         self.current_counter = current_counter
         self.name = 'Countdown Message'
@@ -1863,11 +1898,12 @@ def inject_implicit_onetime(card: BookCard, behavior: List[ESAction]):
             next_flag = next_flag << 1
 
 
-def extract_behavior(card: BookCard, enemy_skillset: List[EnemySkillRef]):
-    if enemy_skill_map is None:
+def extract_behavior(card: BookCard, enemy_skillset: List[EnemySkillRef], registry: EnemySkillRegistry):
+    if registry is None:
         return None
     behavior = []
-    for skill in enemy_skillset:
+    for skill_ref in enemy_skillset:
+        skill = registry.resolve(skill_ref)
         skill_type = es_type(skill)
         if skill_type in BEHAVIOR_MAP:
             new_es = BEHAVIOR_MAP[skill_type](skill)
@@ -1880,7 +1916,7 @@ def extract_behavior(card: BookCard, enemy_skillset: List[EnemySkillRef]):
     return behavior
 
 
-def reformat_json(card_data):
+def reformat_json(card_data, registry: EnemySkillRegistry):
     reformatted = []
     for enemy in card_data:
         if len(enemy.enemy_skill_refs) == 0:
@@ -1891,8 +1927,9 @@ def reformat_json(card_data):
         unknown = {}
 
         # Sequence of enemy skill is important for logic
-        for idx, skill in enumerate(enemy.enemy_skill_refs):
+        for idx, skill_ref in enumerate(enemy.enemy_skill_refs):
             idx += 1
+            skill = registry.resolve(skill_ref)
             if es_type(skill) in BEHAVIOR_MAP:
                 b = BEHAVIOR_MAP[es_type(skill)](skill)
                 if issubclass(type(b), ESPassive):
@@ -1912,21 +1949,19 @@ def reformat_json(card_data):
 
 
 def reformat(raw_cards_json, enemy_skills_json, output_json, mon_id=None):
-    global enemy_skill_map
     print('-- Parsing Enemies --\n')
     with open(enemy_skills_json) as f:
-        enemy_skill_map = {x.enemy_skill_id: x for x
-                           in json.load(f, object_hook=lambda json_dict: DictWithAttributeAccess(json_dict))}
-    if enemy_skill_map is None:
+        registry = EnemySkillRegistry(json.load(f, object_hook=lambda json_dict: DictWithAttributeAccess(json_dict)))
+    if not registry.skills:
         print('Failed to load enemy skill info\n')
     print('Enemy skill json loaded\n')
     with open(raw_cards_json) as f:
         card_data = json.load(f, object_hook=lambda json_dict: DictWithAttributeAccess(json_dict))
     print('Raw cards json loaded\n')
     if mon_id:
-        reformatted = reformat_json([card_data[mon_id]])
+        reformatted = reformat_json([card_data[mon_id]], registry)
     else:
-        reformatted = reformat_json(card_data)
+        reformatted = reformat_json(card_data, registry)
 
     print('Converted {active} enemies\n'.format(active=len(reformatted)))
 
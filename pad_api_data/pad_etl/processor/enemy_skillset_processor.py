@@ -2,8 +2,8 @@
 Contains code to convert a list of enemy behavior logic into a flattened structure
 called a ProcessedSkillset.
 """
+from bisect import bisect_right
 import collections
-import copy
 
 import pad_etl.processor.debug_utils
 from pad_etl.data.card import BookCard
@@ -61,6 +61,8 @@ class HpActions():
         self.hp = hp
         self.timed = timed
         self.repeating = repeating
+        # Set if the simulation ran to the turn ceiling without the state repeating.
+        self.hit_turn_ceiling = False
 
 
 class Moveset(object):
@@ -101,11 +103,25 @@ class ProcessedSkillset(object):
         # Alternate movesets which execute when a specific number of enemies remain.
         self.enemy_remaining_movesets = []  # type: List[EnemyRemainingMoveset]
 
+        # HP checkpoints whose simulation hit the turn ceiling without finding an exact loop;
+        # their repeating actions are a best guess.
+        self.turn_ceiling_hps = []  # type: List[int]
+
+        # Simulated turns that were reused from / added to the LoopThroughMemo.
+        self.memo_hits = 0
+        self.memo_misses = 0
+
 
 class Context(object):
-    """Represents the game state when running through the simulator."""
+    """Represents the game state when running through the simulator.
+
+    Every field holds an immutable value, so clone() is a flat copy of the slots.
+    """
 
-    def __init__(self, level):
+    __slots__ = ('turn', 'is_preemptive', 'do_preemptive', 'flags', 'skill_use', 'counter', 'hp', 'level',
+                 'enemies', 'cards', 'enraged', 'damage_shield', 'status_shield', 'combo_shield', 'registry')
+
+    def __init__(self, level, registry: EnemySkillRegistry):
         self.turn = 1
         # Whether the current turn triggered a preempt flag.
         self.is_preemptive = False
@@ -124,7 +140,7 @@ class Context(object):
         # Number of enemies on the screen.
         self.enemies = 999
         # Cards on the team.
-        self.cards = set()
+        self.cards = frozenset()
         # Turns of enrage, initial:None -> (enrage cooldown period:int<0 ->) enrage:int>0 -> expire:int=0
         self.enraged = None
         # Turns of damage shield, initial:int=0 -> shield up:int>0 -> expire:int=0
@@ -133,12 +149,40 @@ class Context(object):
         self.status_shield = 0
         # Turns of combo shield, initial:int=0 -> shield up:int>0 -> expire:int=0
         self.combo_shield = 0
+        # The server's enemy skills, for the actions the simulator synthesizes.
+        self.registry = registry
 
     def reset(self):
         self.is_preemptive = False
 
+    def state_key(self):
+        """Everything that affects how the next turn plays out.
+
+        Excludes turn, which the simulator never branches on, and is_preemptive, which
+        is reset at the start of every turn.
+        """
+        return (self.do_preemptive, self.flags, self.skill_use, self.counter, self.hp, self.level,
+                self.enemies, self.cards, self.enraged, self.damage_shield, self.status_shield,
+                self.combo_shield)
+
     def clone(self):
-        return copy.deepcopy(self)
+        other = object.__new__(type(self))
+        other.turn = self.turn
+        other.is_preemptive = self.is_preemptive
+        other.do_preemptive = self.do_preemptive
+        other.flags = self.flags
+        other.skill_use = self.skill_use
+        other.counter = self.counter
+        other.hp = self.hp
+        other.level = self.level
+        other.enemies = self.enemies
+        other.cards = self.cards
+        other.enraged = self.enraged
+        other.damage_shield = self.damage_shield
+        other.status_shield = self.status_shield
+        other.combo_shield = self.combo_shield
+        other.registry = self.registry
+        return other
 
     def check_skill_use(self, usage):
         raise NotImplementedError('check_skill_use')
@@ -212,9 +256,11 @@ class Context(object):
 
 
 class CTXBitmap(Context):
-    def __init__(self, level, skill_use_flags):
+    __slots__ = ()
+
+    def __init__(self, level, skill_use_flags, registry: EnemySkillRegistry):
         # TODO: skill_use_flags param might be useless
-        super(CTXBitmap, self).__init__(level)
+        super(CTXBitmap, self).__init__(level, registry)
         self.skill_use = 0
 
     def check_skill_use(self, usage):
@@ -226,9 +272,11 @@ class CTXBitmap(Context):
 
 
 class CTXCounter(Context):
-    def __init__(self, level, skill_use_counter):
+    __slots__ = ()
+
+    def __init__(self, level, skill_use_counter, registry: EnemySkillRegistry):
         # TODO: skill_use_counter param might be useless
-        super(CTXCounter, self).__init__(level)
+        super(CTXCounter, self).__init__(level, registry)
         self.skill_use = 0
 
     def check_skill_use(self, usage):
@@ -246,9 +294,9 @@ class CTXCounter(Context):
             self.skill_use += usage
 
 
-def default_attack():
+def default_attack(registry: EnemySkillRegistry):
     """Indicates that the monster uses its standard attack."""
-    return ESDefaultAttack()
+    return ESDefaultAttack(registry)
 
 
 def loop_through(ctx, behaviors: List[ESBehavior]) -> List[ESBehavior]:
@@ -275,7 +323,7 @@ def loop_through(ctx, behaviors: List[ESBehavior]) -> List[ESBehavior]:
             # Disabling default action for now; doesn't seem to improve things?
             # if len(results) == 0:
             #     # if the result set is empty, add something
-            #     results.append(default_attack())
+            #     results.append(default_attack(ctx.registry))
             return results
         traversed.append(idx)
 
@@ -362,7 +410,7 @@ def loop_through(ctx, behaviors: List[ESBehavior]) -> List[ESBehavior]:
             # Disabling default action for now; doesn't seem to improve things?
             # if len(results) == 0:
             #     # if the result set is empty, add something
-            #     results.append(default_attack())
+            #     results.append(default_attack(ctx.registry))
             return results
 
         if b_type == ESFlagOperation:
@@ -417,7 +465,8 @@ def loop_through(ctx, behaviors: List[ESBehavior]) -> List[ESBehavior]:
         if b_type == ESCountdown:
             ctx.counter -= 1
             if ctx.counter > 0:
-                results.append(ESCountdownMessage(b.enemy_skill_id, ctx.counter))
+                results.append(ESCountdownMessage(
+                    ctx.registry.resolve(EnemySkillRef(b.enemy_skill_id, 0, 0)), ctx.counter))
                 return results
             else:
                 idx += 1
@@ -510,20 +559,168 @@ def extract_preemptives(ctx: Context, behaviors: List[Any]):
         return original_ctx, None
 
 
-def extract_turn_behaviors(ctx: Context, behaviors: List[ESBehavior], hp_checkpoint: int) -> List[List[ESBehavior]]:
-    """Simulate the first 20 turns at a specific hp checkpoint."""
+# Turns that simulating an hp checkpoint advances the shared context by.
+CHECKPOINT_TURNS = 20
+
+# Default ceiling on the turns simulated per hp checkpoint while the state hasn't repeated.
+DEFAULT_MAX_TURNS = 100
+
+
+def simulator_state(ctx: Context, behaviors: List[ESBehavior]):
+    """Hashable key for the full simulator state going into a turn.
+
+    loop_through only ever nulls out behaviors, so the number of nulled entries
+    identifies which ones are gone.
+    """
+    return ctx.state_key(), behaviors.count(None)
+
+
+class LoopThroughMemo(object):
+    """Caches loop_through for one behavior list, keyed on a canonical simulator state.
+
+    The state is canonical in that hp and enemies are reduced to the outcome of every
+    comparison the behaviors make against them, so e.g. the hp checkpoints on either
+    side of a threshold-free range, or enemy counts that no branch tells apart, share
+    entries. A hit replays the turn: the skills used, the context fields loop_through
+    changes, and the behaviors it nulls out.
+    """
+
+    # The context fields loop_through can modify.
+    OUTPUT_FIELDS = ('is_preemptive', 'do_preemptive', 'flags', 'skill_use', 'counter',
+                     'enraged', 'damage_shield', 'status_shield', 'combo_shield')
+
+    def __init__(self, behaviors: List[ESBehavior]):
+        self.behaviors = behaviors
+        # state -> (skills, output field values, indexes nulled)
+        self.cache = {}  # type: Dict[Any, Tuple[List[ESBehavior], Tuple, Tuple[int]]]
+        self.hits = 0
+        self.misses = 0
+
+        hp_thresholds = set()
+        self.enemy_equal_values = set()
+        self.enemy_greater_values = set()
+        for b in behaviors:
+            if type(b) == ESBranchHP:
+                hp_thresholds.add(b.branch_value)
+            if skill_has_condition(b) and b.condition.hp_threshold:
+                hp_thresholds.add(b.condition.hp_threshold)
+            if type(b) == ESBranchRemainingEnemies:
+                self.enemy_equal_values.add(b.branch_value)
+            if type(b) == ESAttackUPRemainingEnemies and b.enemy_count is not None:
+                self.enemy_greater_values.add(b.enemy_count)
+        self.hp_thresholds = sorted(hp_thresholds)
+
+    def state(self, ctx: Context):
+        # Every hp comparison is hp >= threshold (or its negation), so the number of
+        # thresholds at or below hp decides them all.
+        hp_band = bisect_right(self.hp_thresholds, ctx.hp)
+        enemies = (tuple(ctx.enemies == v for v in self.enemy_equal_values),
+                   tuple(ctx.enemies > v for v in self.enemy_greater_values))
+        return (ctx.do_preemptive, ctx.flags, ctx.skill_use, ctx.counter, hp_band, ctx.level, enemies,
+                ctx.cards, ctx.enraged, ctx.damage_shield, ctx.status_shield, ctx.combo_shield,
+                self.behaviors.count(None))
+
+    def loop_through(self, ctx: Context) -> List[ESBehavior]:
+        """Same as loop_through(ctx, self.behaviors); the returned list is the caller's to modify."""
+        state = self.state(ctx)
+        entry = self.cache.get(state)
+        if entry is None:
+            self.misses += 1
+            nulled = {idx for idx, b in enumerate(self.behaviors) if b is None}
+            skills = loop_through(ctx, self.behaviors)
+            entry = (list(skills),
+                     tuple(getattr(ctx, f) for f in self.OUTPUT_FIELDS),
+                     tuple(idx for idx, b in enumerate(self.behaviors) if b is None and idx not in nulled))
+            self.cache[state] = entry
+            return skills
+
+        self.hits += 1
+        skills, outputs, newly_nulled = entry
+        for field, value in zip(self.OUTPUT_FIELDS, outputs):
+            setattr(ctx, field, value)
+        for idx in newly_nulled:
+            self.behaviors[idx] = None
+        return list(skills)
+
+
+def extract_turn_behaviors(ctx: Context, behaviors: List[ESBehavior], hp_checkpoint: int,
+                           max_turns: int=DEFAULT_MAX_TURNS,
+                           memo: LoopThroughMemo=None) -> Tuple[List[List[ESBehavior]], Optional[Tuple[int, int]]]:
+    """Simulate turns at a specific hp checkpoint until the state repeats, or for max_turns turns.
+
+    The simulation is deterministic, so once a turn starts in a state that an earlier
+    turn started in, every turn from there on repeats. Simulation stops at that point
+    and the (start, end) indexes of the repeated state cycle are returned alongside the
+    turns simulated; the cycle is None if no state repeated within max_turns.
+    If memo is set (for this behaviors list), turns are simulated through it.
+
+    Turns past CHECKPOINT_TURNS only look for the repeat: the one-time behaviors they
+    use up are restored afterwards, so behaviors is left as the first CHECKPOINT_TURNS
+    turns leave it, which is the state later checkpoints start from.
+
+    Compared to searching the simulated turns themselves for a loop, this changes two
+    kinds of skillset:
+    * a counter that runs out late in the horizon (e.g. blind until the counter passes
+      17, then nothing) now gives timed turns ending in the idle loop, where the turn
+      search fit a short repeat into the turns before the counter ran out;
+    * loops too long to be seen twice in the horizon (e.g. a 19 turn countdown) are
+      now found, where the turn search failed with 'No loop found'.
+    """
     hp_ctx = ctx.clone()
     hp_ctx.hp = hp_checkpoint
     turn_data = []
-    for idx in range(0, 20):
-        turn_data.append(loop_through(hp_ctx, behaviors))
+    seen_states = {}
+    cycle = None
+    checkpoint_behaviors = None
+    for idx in range(0, max_turns + 1):
+        state = simulator_state(hp_ctx, behaviors)
+        if state in seen_states:
+            cycle = seen_states[state], idx
+            break
+        seen_states[state] = idx
+        if idx == CHECKPOINT_TURNS:
+            checkpoint_behaviors = list(behaviors)
+        if idx < max_turns:
+            turn_data.append(memo.loop_through(hp_ctx) if memo else loop_through(hp_ctx, behaviors))
+
+    if checkpoint_behaviors is not None:
+        behaviors[:] = checkpoint_behaviors
+
+    # The passed-in context advances a fixed number of turns per checkpoint, however
+    # many were simulated; later checkpoints start from it.
+    for idx in range(0, CHECKPOINT_TURNS):
         ctx.turn_event()
 
-    return turn_data
+    return turn_data, cycle
+
+
+def loop_from_state_cycle(turn_data: List[List[ESBehavior]], cycle_start: int, cycle_end: int) -> Tuple[int, int]:
+    """Find the shortest, earliest loop in turns that repeat from cycle_start with period cycle_end - cycle_start.
+
+    A state cycle is exact, but different states can produce the same actions, so the
+    actions may repeat with a shorter period, or start repeating a few turns earlier.
+    """
+    cycle_len = cycle_end - cycle_start
+    loop_len = cycle_len
+    for period in range(1, cycle_len):
+        if cycle_len % period == 0 and all(turn_data[idx] == turn_data[idx + period]
+                                           for idx in range(cycle_start, cycle_end - period)):
+            loop_len = period
+            break
+
+    loop_start = cycle_start
+    while loop_start > 0 and turn_data[loop_start - 1] == turn_data[loop_start - 1 + loop_len]:
+        loop_start -= 1
+    return loop_start, loop_start + loop_len
 
 
 def extract_loop_indexes(turn_data: List[ESBehavior]) -> Tuple[int, int]:
-    """Find loops in the data."""
+    """Find loops in the data.
+
+    Only used when the simulator state never repeated within the turn ceiling; compares
+    candidate slices of the turns themselves, so callers pass at most CHECKPOINT_TURNS
+    turns.
+    """
     # Loop over every turn
     for i_idx, check_data in enumerate(turn_data):
         # Loop over every following turn. If the outer turn matches an inner turn moveset,
@@ -579,15 +776,23 @@ def extract_loop_skills(hp: int, turn_data: list, loop_start: int, loop_end: int
     return HpActions(hp, timed_skill_groups, repeating_skill_groups)
 
 
-def compute_enemy_actions(ctx: Context, behaviors: List[ESBehavior], hp_checkpoints: List[int]) -> List[HpActions]:
+def compute_enemy_actions(ctx: Context, behaviors: List[ESBehavior], hp_checkpoints: List[int],
+                          max_turns: int=DEFAULT_MAX_TURNS, memo: LoopThroughMemo=None) -> List[HpActions]:
     # Compute turn behaviors for every hp checkpoint
-    hp_to_turn_behaviors = {hp: extract_turn_behaviors(ctx, behaviors, hp) for hp in hp_checkpoints}
+    hp_to_turn_behaviors = {hp: extract_turn_behaviors(ctx, behaviors, hp, max_turns, memo)
+                            for hp in hp_checkpoints}
 
     # Convert turn behaviors into fixed turns and repeating loops.
     hp_to_actions = {}  # type Map[int, HpActions]
-    for hp, turn in hp_to_turn_behaviors.items():
-        loop_start, loop_end = extract_loop_indexes(turn)
+    for hp, (turn, cycle) in hp_to_turn_behaviors.items():
+        if cycle:
+            loop_start, loop_end = loop_from_state_cycle(turn, *cycle)
+        else:
+            # The slice search is roughly cubic in the turn count
+            turn = turn[:CHECKPOINT_TURNS]
+            loop_start, loop_end = extract_loop_indexes(turn)
         hp_to_actions[hp] = extract_loop_skills(hp, turn, loop_start, loop_end)
+        hp_to_actions[hp].hit_turn_ceiling = cycle is None
 
     # Starting from the top hp bracket and extending down, compute the true timed actions.
     for chp_idx in range(len(hp_checkpoints)):
@@ -633,7 +838,14 @@ def compute_enemy_actions(ctx: Context, behaviors: List[ESBehavior], hp_checkpoi
 
 
 def convert(card: BookCard, enemy_behavior: List[ESBehavior],
-            level: int, enemy_skill_effect: int, enemy_skill_effect_type: int, force_one_enemy: bool=False):
+            level: int, enemy_skill_effect: int, enemy_skill_effect_type: int,
+            registry: EnemySkillRegistry, force_one_enemy: bool=False, max_turns: int=DEFAULT_MAX_TURNS):
+    """Simulates enemy_behavior at the given level, flattening it into a ProcessedSkillset.
+
+    registry is the card's server's enemy skills; the simulator resolves the actions
+    it synthesizes (default attacks, countdown messages) there. Each hp checkpoint is
+    simulated for at most max_turns turns.
+    """
     skillset = ProcessedSkillset(level)
 
     # Behavior is 1-indexed, so stick a fake row in to start
@@ -652,14 +864,14 @@ def convert(card: BookCard, enemy_behavior: List[ESBehavior],
 
     # Pick the correct enemy_skill_effect model to use
     if enemy_skill_effect_type == 0:
-        ctx = CTXBitmap(level, enemy_skill_effect)
+        ctx = CTXBitmap(level, enemy_skill_effect, registry)
     elif enemy_skill_effect_type == 1:
-        ctx = CTXCounter(level, enemy_skill_effect)
+        ctx = CTXCounter(level, enemy_skill_effect, registry)
     else:
-        # ctx = Context(level)
+        # ctx = Context(level, registry)
         # For now fall back to the old context implementation to prevent errors in log.
         print('Incorrect context used')
-        ctx = CTXBitmap(level, enemy_skill_effect)
+        ctx = CTXBitmap(level, enemy_skill_effect, registry)
 
     if force_one_enemy:
         ctx.enemies = 1
@@ -676,8 +888,13 @@ def convert(card: BookCard, enemy_behavior: List[ESBehavior],
             # This monster terminates the battle immediately.
             return skillset
 
+    # The standard and enemy remaining movesets all simulate the same behaviors, often
+    # from equivalent states.
+    memo = LoopThroughMemo(behaviors)
+
     # Compute the standard action moveset
-    hp_actions = compute_enemy_actions(ctx.clone(), behaviors, hp_checkpoints)
+    hp_actions = compute_enemy_actions(ctx.clone(), behaviors, hp_checkpoints, max_turns, memo)
+    skillset.turn_ceiling_hps.extend(a.hp for a in hp_actions if a.hit_turn_ceiling)
     clean_skillset(skillset.moveset, hp_actions)
 
     # Simulate enemies being defeated
@@ -688,7 +905,8 @@ def convert(card: BookCard, enemy_behavior: List[ESBehavior],
             enemy_moveset = EnemyRemainingMoveset(ecount)
             enemy_ctx = ctx.clone()
             enemy_ctx.enemies = ecount
-            enemy_actions = compute_enemy_actions(enemy_ctx, behaviors, hp_checkpoints)
+            enemy_actions = compute_enemy_actions(enemy_ctx, behaviors, hp_checkpoints, max_turns, memo)
+            skillset.turn_ceiling_hps.extend(a.hp for a in enemy_actions if a.hit_turn_ceiling)
             clean_skillset(enemy_moveset, enemy_actions)
             enemy_movesets.append(enemy_moveset)
 
@@ -721,6 +939,8 @@ def convert(card: BookCard, enemy_behavior: List[ESBehavior],
             if moveset.hp_actions:
                 skillset.enemy_remaining_movesets.append(moveset)
 
+    skillset.memo_hits = memo.hits
+    skillset.memo_misses = memo.misses
     return skillset
 
 
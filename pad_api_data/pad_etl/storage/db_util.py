@@ -1,38 +1,142 @@
 import logging
 import random
+import time
+from contextlib import contextmanager
+from typing import Any, List, Sequence, Tuple
 
-import pymysql
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
 
-from .sql_item import SqlItem, _col_compare, _tbl_name_ref, process_col_mappings
+from . import sqlite_db
+from .query_stats import QueryStats
+from .sql_item import SqlItem, _col_compare, _col_name_ref, _tbl_name_ref
+from .sql_item import object_to_params, process_col_mappings
 
 
 logger = logging.getLogger('database')
 logger.setLevel(logging.ERROR)
 
 
+def _connect_mysql(db_config):
+    if pymysql is None:
+        raise ValueError('the mysql backend requires the pymysql package')
+    return pymysql.connect(host=db_config['host'],
+                           user=db_config['user'],
+                           password=db_config['password'],
+                           db=db_config['db'],
+                           charset=db_config['charset'],
+                           cursorclass=pymysql.cursors.DictCursor,
+                           autocommit=True)
+
+
+# Backend name -> function from the db config to a pymysql-like connection
+BACKENDS = {
+    'mysql': _connect_mysql,
+    'sqlite': sqlite_db.connect,
+}
+
+
 class DbWrapper(object):
-    def __init__(self, dry_run: bool=True):
+    def __init__(self, dry_run: bool=True, stats: QueryStats=None):
         self.dry_run = dry_run
         self.connection = None
+        self._transaction_depth = 0
+        # Tracked items written inside the open transaction; marked clean once it commits
+        self._clean_on_commit = []  # type: List[SqlItem]
+        # If set, every statement sent to the database is timed and counted
+        self.stats = stats
 
     def connect(self, db_config):
+        """Connects using db_config['backend'] ('mysql' by default, or 'sqlite'); see BACKENDS."""
+        backend = db_config.get('backend', 'mysql')
+        if backend not in BACKENDS:
+            raise ValueError('unknown db backend: {}'.format(backend))
         logger.debug('DB Connecting')
-        self.connection = pymysql.connect(host=db_config['host'],
-                                          user=db_config['user'],
-                                          password=db_config['password'],
-                                          db=db_config['db'],
-                                          charset=db_config['charset'],
-                                          cursorclass=pymysql.cursors.DictCursor,
-                                          autocommit=True)
+        self.connection = BACKENDS[backend](db_config)
         logger.info('DB Connected')
 
-    def execute(self, cursor, sql):
-        logger.debug('Executing: %s', sql)
-        return cursor.execute(sql)
+    def execute(self, cursor, sql, params=None):
+        """Runs sql; if params is set, sql is a %s template and the driver binds the values."""
+        if params is None:
+            logger.debug('Executing: %s', sql)
+        else:
+            logger.debug('Executing: %s with %s', sql, params)
+        return self._run_timed(sql, cursor.execute, params)
+
+    def _run_timed(self, sql, run_fn, params):
+        """Returns run_fn(sql, params), recording how long it took in stats if enabled."""
+        if self.stats is None:
+            return run_fn(sql, params)
+        start = time.perf_counter()
+        result = run_fn(sql, params)
+        self.stats.record(sql, time.perf_counter() - start, result)
+        return result
+
+    @contextmanager
+    def phase(self, name: str):
+        """Attributes the statements run inside the block to the named phase in stats, if enabled."""
+        if self.stats is None:
+            yield
+            return
+        with self.stats.phase(name):
+            yield
+
+    def set_phase(self, name: str):
+        """Attributes subsequent statements to the named phase in stats, if enabled."""
+        if self.stats is not None:
+            self.stats.set_phase(name)
+
+    @contextmanager
+    def transaction(self):
+        """Runs everything inside the block as one transaction, committed when it exits cleanly.
+
+        The connection autocommits otherwise. Nested blocks join the outermost transaction.
+        """
+        if self.dry_run or self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        logger.debug('Beginning transaction')
+        self.connection.begin()
+        self._transaction_depth = 1
+        try:
+            yield
+        except BaseException:
+            logger.warn('Rolling back transaction')
+            self._clean_on_commit = []
+            self.connection.rollback()
+            raise
+        else:
+            self.connection.commit()
+            logger.debug('Committed transaction')
+            for item in self._clean_on_commit:
+                item.mark_clean()
+        finally:
+            self._clean_on_commit = []
+            self._transaction_depth = 0
+
+    def mark_clean_on_commit(self, item: SqlItem):
+        """Marks a tracked item clean once its writes are committed; never in a dry run.
+
+        Outside a transaction the writes have already been autocommitted. Inside one the item
+        is held until the outermost transaction commits, and dropped if it's rolled back.
+        """
+        if self.dry_run:
+            return
+        if self._transaction_depth:
+            self._clean_on_commit.append(item)
+        else:
+            item.mark_clean()
 
-    def fetch_data(self, sql):
+    def fetch_data(self, sql, params=None):
         with self.connection.cursor() as cursor:
-            self.execute(cursor, sql)
+            self.execute(cursor, sql, params)
         return list(cursor.fetchall())
 
     def load_to_key_value(self, key_name, value_name, table_name, where_clause=None):
@@ -44,9 +148,9 @@ class DbWrapper(object):
             data = list(cursor.fetchall())
             return {row['k']: row['v'] for row in data}
 
-    def get_single_or_no_row(self, sql):
+    def get_single_or_no_row(self, sql, params=None):
         with self.connection.cursor() as cursor:
-            self.execute(cursor, sql)
+            self.execute(cursor, sql, params)
             data = list(cursor.fetchall())
             num_rows = len(data)
             if num_rows > 1:
@@ -56,9 +160,9 @@ class DbWrapper(object):
             else:
                 return data[0]
 
-    def get_single_value(self, sql, op=str, fail_on_empty=True):
+    def get_single_value(self, sql, op=str, fail_on_empty=True, params=None):
         with self.connection.cursor() as cursor:
-            self.execute(cursor, sql)
+            self.execute(cursor, sql, params)
             data = list(cursor.fetchall())
             num_rows = len(data)
             if num_rows == 0:
@@ -78,7 +182,7 @@ class DbWrapper(object):
             _col_compare(obj_type.KEY_COL))
         sql = sql.format(**{obj_type.KEY_COL: key_val})
         data = self.get_single_or_no_row(sql)
-        return obj_type(**process_col_mappings(obj_type, data)) if data else None
+        return _row_to_object(obj_type, data) if data else None
 
     def load_multiple_objects(self, obj_type, key_val):
         sql = 'SELECT * FROM {} WHERE {}'.format(
@@ -86,18 +190,39 @@ class DbWrapper(object):
             _col_compare(obj_type.LIST_COL))
         sql = sql.format(**{obj_type.LIST_COL: key_val})
         data = self.fetch_data(sql)
-        return [obj_type(**process_col_mappings(obj_type, d)) for d in data]
+        return [_row_to_object(obj_type, d) for d in data]
+
+    def fetch_rows_in(self, table_name: str, col: str, values: List[Any], chunk_size: int=1000):
+        """Fetches every row of table_name whose col is one of values, with one query per chunk of values."""
+        values = list(dict.fromkeys(v for v in values if v is not None))
+        results = []
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            sql = 'SELECT * FROM {} WHERE {} IN ({})'.format(
+                _tbl_name_ref(table_name),
+                _col_name_ref(col),
+                ', '.join(['%s'] * len(chunk)))
+            results.extend(self.fetch_data(sql, tuple(chunk)))
+        return results
+
+    def load_objects_in(self, obj_type, col: str, values: List[Any], chunk_size: int=1000):
+        """Loads every obj_type row whose col is one of values.
 
-    def check_existing(self, sql):
+        Rows come back in the order the database returns them; callers group them by col.
+        """
+        data = self.fetch_rows_in(obj_type.TABLE, col, values, chunk_size=chunk_size)
+        return [_row_to_object(obj_type, d) for d in data]
+
+    def check_existing(self, sql, params=None):
         with self.connection.cursor() as cursor:
-            num_rows = self.execute(cursor, sql)
+            num_rows = self.execute(cursor, sql, params)
             if num_rows > 1:
                 raise ValueError('got too many results:', num_rows, sql)
             return bool(num_rows)
 
-    def check_existing_value(self, sql):
+    def check_existing_value(self, sql, params=None):
         with self.connection.cursor() as cursor:
-            num_rows = self.execute(cursor, sql)
+            num_rows = self.execute(cursor, sql, params)
             if num_rows > 1:
                 raise ValueError('got too many results:', num_rows, sql)
             elif num_rows == 0:
@@ -109,43 +234,147 @@ class DbWrapper(object):
                 else:
                     return row_values[0]
 
-    def insert_item(self, sql):
+    def insert_item(self, sql, params=None):
         with self.connection.cursor() as cursor:
             if self.dry_run:
                 logger.warn('not inserting item due to dry run')
                 return random.randrange(-99999, -1)
-            self.execute(cursor, sql)
+            self.execute(cursor, sql, params)
             data = list(cursor.fetchall())
             num_rows = len(data)
             if num_rows > 0:
                 raise ValueError('got too many results for insert:', num_rows, sql)
             return cursor.lastrowid
 
+    def execute_many(self, sql, rows: List[Sequence[Any]]):
+        """Runs a parameterized (%s) statement once per row in a single call."""
+        if not rows:
+            return 0
+        with self.connection.cursor() as cursor:
+            if self.dry_run:
+                logger.warn('not executing %s rows due to dry run', len(rows))
+                return 0
+            logger.debug('Executing %s rows: %s', len(rows), sql)
+            return self._run_timed(sql, cursor.executemany, rows)
+
+    def insert_rows(self, table_name: str, cols: List[str], rows: List[Sequence[Any]], update_cols: List[str]=None):
+        """Inserts many rows with a single multi-row INSERT.
+
+        Each entry in rows holds the values for cols, bound by the driver like execute_many's.
+        If update_cols is set, rows whose key already exists have those columns updated instead.
+        """
+        if not rows:
+            return 0
+        row_template = '(' + ', '.join(['%s'] * len(cols)) + ')'
+        sql = 'INSERT INTO {}'.format(_tbl_name_ref(table_name))
+        sql += ' (' + ', '.join(map(_col_name_ref, cols)) + ')'
+        sql += ' VALUES ' + ', '.join([row_template] * len(rows))
+        if update_cols:
+            sql += ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '{0} = VALUES({0})'.format(_col_name_ref(c)) for c in update_cols)
+
+        with self.connection.cursor() as cursor:
+            if self.dry_run:
+                logger.warn('not inserting %s rows due to dry run', len(rows))
+                return 0
+            return self.execute(cursor, sql, [v for row in rows for v in row])
+
+    def item_needs_update(self, item: SqlItem):
+        """Whether item differs from its row; tracked items are compared locally, without a query."""
+        dirty = item.is_dirty()
+        if dirty is not None:
+            return dirty
+        update_sql_params = item.needs_update_sql_params()
+        return bool(update_sql_params) and not self.check_existing(*update_sql_params)
+
     def insert_or_update(self, item: SqlItem):
         key = item.key_value()
         if item.uses_alternate_key_lookup():
-            key = self.get_single_value(item.exists_sql(), op=int, fail_on_empty=False)
+            sql, params = item.exists_sql_params()
+            key = self.get_single_value(sql, op=int, fail_on_empty=False, params=params)
             item.set_key_value(key)
 
             if not key:
                 logger.info('item (alt) needed insert: %s %s', type(item), key)
-                key = self.insert_item(item.insert_sql())
-            elif not self.check_existing(item.needs_update_sql()):
+                key = self.insert_item(*item.insert_sql_params())
+            elif self.item_needs_update(item):
                 logger.info('item (alt) needed update: %s %s', type(item), key)
-                self.insert_item(item.update_sql())
+                self.insert_item(*item.update_sql_params())
 
         elif not item.uses_local_primary_key():
-            if not self.check_existing(item.exists_sql()):
+            # A tracked item was loaded from its row, so it's known to exist
+            if not item.tracks_changes() and not self.check_existing(*item.exists_sql_params()):
                 logger.info('item (fk) needed insert: %s %s', type(item), key)
-                key = self.insert_item(item.insert_sql())
-            elif not self.check_existing(item.needs_update_sql()):
+                key = self.insert_item(*item.insert_sql_params())
+            elif self.item_needs_update(item):
                 logger.info('item (fk) needed update: %s %s', type(item), key)
-                self.insert_item(item.update_sql())
+                self.insert_item(*item.update_sql_params())
         else:
             if item.needs_insert():
                 logger.info('item needed insert: %s %s', type(item), key)
-                key = self.insert_item(item.insert_sql())
-            elif not self.check_existing(item.needs_update_sql()):
+                key = self.insert_item(*item.insert_sql_params())
+            elif self.item_needs_update(item):
                 logger.info('item needed update: %s %s', type(item), key)
-                self.insert_item(item.update_sql())
+                self.insert_item(*item.update_sql_params())
+
+        if item.tracks_changes():
+            self.mark_clean_on_commit(item)
         return key
+
+
+def _row_to_object(obj_type, row):
+    """Builds an obj_type from a DB row; SqlItems start tracking changes against the row."""
+    obj = obj_type(**process_col_mappings(obj_type, dict(row)))
+    if isinstance(obj, SqlItem):
+        obj.mark_clean(row)
+    return obj
+
+
+class BatchWriter(object):
+    """Buffers rows for a table and writes them with multi-row INSERTs.
+
+    Pending rows are written once batch_size of them accumulate, or when a row is
+    added more than flush_interval seconds after the oldest pending one. There is no
+    timer: flush_interval is only checked by add(), so rows stay pending through any
+    pause until the next add() or flush(). Use as a context manager (or call flush)
+    to write whatever is left at the end; if the block raises, pending rows are
+    dropped rather than written. rows_written stays 0 in dry runs.
+    """
+
+    def __init__(self, db_wrapper: DbWrapper, table_name: str, cols: List[str], update_cols: List[str]=None,
+                 batch_size: int=500, flush_interval: float=30):
+        self.db_wrapper = db_wrapper
+        self.table_name = table_name
+        self.cols = list(cols)
+        self.update_cols = update_cols
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending = []  # type: List[Tuple]
+        self.pending_since = None
+        self.rows_written = 0
+
+    def add(self, item):
+        """Queues an item (SqlItem, plain object or dict) to be written."""
+        self.pending.append(object_to_params(item, self.cols))
+        if self.pending_since is None:
+            self.pending_since = time.time()
+
+        if len(self.pending) >= self.batch_size or time.time() - self.pending_since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.db_wrapper.insert_rows(self.table_name, self.cols, self.pending, update_cols=self.update_cols)
+        if not self.db_wrapper.dry_run:
+            self.rows_written += len(self.pending)
+        self.pending = []
+        self.pending_since = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
@@ -1,10 +1,15 @@
+import logging
 import time
 
 from enum import Enum
+from typing import Any, Dict, List
 
 from . import db_util
 from .sql_item import SqlItem, SimpleSqlItem
 from .sql_item import full_columns, dump
+from .unit_of_work import UnitOfWork
+
+logger = logging.getLogger('database')
 
 
 class Icon(SimpleSqlItem):
@@ -349,77 +354,131 @@ class DungeonSkill(SqlItem):
 
 
 class DungeonLoader(object):
+    """Loads and saves a Dungeon along with everything hanging off it.
+
+    Loading fetches each table of the dungeon graph with one set-based query
+    (WHERE <fk> IN (...)) for all the requested dungeons together, and then
+    fills in the resolved_* fields in memory, so the number of queries doesn't
+    grow with the number of floors or monsters.
+    """
+
     def __init__(self, db_wrapper: db_util.DbWrapper):
         self.db_wrapper = db_wrapper
 
     def load_dungeon(self, dungeon_seq: int):
-        dungeon = self.db_wrapper.load_single_object(Dungeon, dungeon_seq)
+        return self.load_dungeons([dungeon_seq]).get(dungeon_seq)
+
+    def load_dungeons(self, dungeon_seqs: List[int]) -> Dict[int, Dungeon]:
+        """Loads many dungeons at once, returning dungeon_seq -> Dungeon for the ones that exist."""
+        dungeons = self.db_wrapper.load_objects_in(Dungeon, Dungeon.KEY_COL, dungeon_seqs)
 
-        if dungeon.tdt_seq:
-            dungeon.resolved_dungeon_type = self.db_wrapper.load_single_object(
-                DungeonType, dungeon.tdt_seq)
+        dungeon_types = _by_key(self.db_wrapper.load_objects_in(
+            DungeonType, DungeonType.KEY_COL, [d.tdt_seq for d in dungeons if d.tdt_seq]))
+        for d in dungeons:
+            if d.tdt_seq:
+                d.resolved_dungeon_type = dungeon_types.get(d.tdt_seq)
 
-        dungeon.resolved_sub_dungeons = self.load_sub_dungeons(dungeon_seq)
+        sub_dungeons = self._load_sub_dungeons([d.dungeon_seq for d in dungeons])
+        for d in dungeons:
+            d.resolved_sub_dungeons = sub_dungeons.get(d.dungeon_seq, [])
 
-        return dungeon
+        return {d.dungeon_seq: d for d in dungeons}
 
     def load_sub_dungeons(self, dungeon_seq: int):
-        sub_dungeons = self.db_wrapper.load_multiple_objects(SubDungeon, dungeon_seq)
+        return self._load_sub_dungeons([dungeon_seq]).get(dungeon_seq, [])
+
+    def _load_sub_dungeons(self, dungeon_seqs: List[int]) -> Dict[int, List[SubDungeon]]:
+        sub_dungeons = self.db_wrapper.load_objects_in(SubDungeon, SubDungeon.LIST_COL, dungeon_seqs)
+        tsd_seqs = [sd.tsd_seq for sd in sub_dungeons]
+
+        dungeon_monsters = self._load_dungeon_monsters(tsd_seqs)
+        scores = _by_key(self.db_wrapper.load_objects_in(SubDungeonScore, SubDungeonScore.KEY_COL, tsd_seqs))
+        rewards = _by_key(self.db_wrapper.load_objects_in(SubDungeonReward, SubDungeonReward.KEY_COL, tsd_seqs))
+        points = _by_key(self.db_wrapper.load_objects_in(SubDungeonPoint, SubDungeonPoint.KEY_COL, tsd_seqs))
+
         for sd in sub_dungeons:
             tsd_seq = sd.tsd_seq
-            sd.resolved_dungeon_monsters = self.load_dungeon_monster(tsd_seq)
-            sd.resolved_sub_dungeon_score = self.db_wrapper.load_single_object(
-                SubDungeonScore, tsd_seq)
-            sd.resolved_sub_dungeon_reward = self.db_wrapper.load_single_object(
-                SubDungeonReward, tsd_seq)
-            sd.resolved_sub_dungeon_point = self.db_wrapper.load_single_object(
-                SubDungeonPoint, tsd_seq)
-        return sub_dungeons
+            sd.resolved_dungeon_monsters = dungeon_monsters.get(tsd_seq, [])
+            sd.resolved_sub_dungeon_score = scores.get(tsd_seq)
+            sd.resolved_sub_dungeon_reward = rewards.get(tsd_seq)
+            sd.resolved_sub_dungeon_point = points.get(tsd_seq)
+        return _by_list_key(sub_dungeons)
 
     def load_dungeon_monster(self, tsd_seq):
-        dungeon_monsters = self.db_wrapper.load_multiple_objects(DungeonMonster, tsd_seq)
+        return self._load_dungeon_monsters([tsd_seq]).get(tsd_seq, [])
+
+    def _load_dungeon_monsters(self, tsd_seqs: List[int]) -> Dict[int, List[DungeonMonster]]:
+        dungeon_monsters = self.db_wrapper.load_objects_in(DungeonMonster, DungeonMonster.LIST_COL, tsd_seqs)
+        drops = _by_list_key(self.db_wrapper.load_objects_in(
+            DungeonMonsterDrop, DungeonMonsterDrop.LIST_COL, [dm.tdm_seq for dm in dungeon_monsters]))
         for dm in dungeon_monsters:
-            dm.resolved_dungeon_monster_drops = self.db_wrapper.load_multiple_objects(
-                DungeonMonsterDrop, dm.tdm_seq)
+            dm.resolved_dungeon_monster_drops = drops.get(dm.tdm_seq, [])
             # dm.resolved_dungeon_skills = self.db_wrapper.load_multiple_objects(DungeonMonsterDrop, tsd_seq)
-        return dungeon_monsters
+        return _by_list_key(dungeon_monsters)
 
     def save_dungeon(self, dungeon: Dungeon):
-        # TODO: Run save in a transaction and commit on success
+        """Saves the dungeon and everything under it in one transaction.
+
+        Each level of the graph is looked up with one query per table and the updates
+        are sent batched when the transaction commits; see UnitOfWork.
+        """
         # TODO: Save DungeonType?
         if dungeon.resolved_dungeon_type:
             dungeon.tdt_seq = dungeon.resolved_dungeon_type.tdt_seq
-        dungeon_seq = self.db_wrapper.insert_or_update(dungeon)
-        for sd in dungeon.resolved_sub_dungeons:
-            sd.dungeon_seq = dungeon_seq
-            self.save_sub_dungeon(sd)
-
-    def save_sub_dungeon(self, sub_dungeon: SubDungeon):
-        tsd_seq = self.db_wrapper.insert_or_update(sub_dungeon)
-        for dm in sub_dungeon.resolved_dungeon_monsters:
-            dm.dungeon_seq = sub_dungeon.dungeon_seq
-            dm.tsd_seq = tsd_seq
-            self.save_dungeon_monster(dm)
-
-        if sub_dungeon.resolved_sub_dungeon_score:
-            sub_dungeon.resolved_sub_dungeon_score.tsd_seq = tsd_seq
-            self.db_wrapper.insert_or_update(sub_dungeon.resolved_sub_dungeon_score)
-
-        if sub_dungeon.resolved_sub_dungeon_reward:
-            sub_dungeon.resolved_sub_dungeon_reward.tsd_seq = tsd_seq
-            self.db_wrapper.insert_or_update(sub_dungeon.resolved_sub_dungeon_reward)
-
-        if sub_dungeon.resolved_sub_dungeon_point:
-            sub_dungeon.resolved_sub_dungeon_point.tsd_seq = tsd_seq
-            self.db_wrapper.insert_or_update(sub_dungeon.resolved_sub_dungeon_point)
-
-    def save_dungeon_monster(self, dungeon_monster: DungeonMonster):
-        tdm_seq = self.db_wrapper.insert_or_update(dungeon_monster)
-
-        for dmd in dungeon_monster.resolved_dungeon_monster_drops:
-            dmd.tdm_seq = tdm_seq
-            self.db_wrapper.insert_or_update(dmd)
-
-        for ds in dungeon_monster.resolved_dungeon_skills:
-            # Currently ignoring skills
-            pass
+
+        with UnitOfWork(self.db_wrapper) as uow:
+            dungeon_seq, = uow.save([dungeon])
+
+            sub_dungeons = dungeon.resolved_sub_dungeons
+            for sd in sub_dungeons:
+                sd.dungeon_seq = dungeon_seq
+            tsd_seqs = uow.save(sub_dungeons)
+
+            dungeon_monsters = []
+            sub_dungeon_items = []
+            for sd, tsd_seq in zip(sub_dungeons, tsd_seqs):
+                for dm in sd.resolved_dungeon_monsters:
+                    dm.dungeon_seq = sd.dungeon_seq
+                    dm.tsd_seq = tsd_seq
+                    dungeon_monsters.append(dm)
+
+                for item in [sd.resolved_sub_dungeon_score,
+                             sd.resolved_sub_dungeon_reward,
+                             sd.resolved_sub_dungeon_point]:
+                    if item:
+                        item.tsd_seq = tsd_seq
+                        sub_dungeon_items.append(item)
+
+            tdm_seqs = uow.save(dungeon_monsters)
+            uow.save(sub_dungeon_items)
+
+            drops = []
+            for dm, tdm_seq in zip(dungeon_monsters, tdm_seqs):
+                for dmd in dm.resolved_dungeon_monster_drops:
+                    dmd.tdm_seq = tdm_seq
+                    drops.append(dmd)
+                for ds in dm.resolved_dungeon_skills:
+                    # Currently ignoring skills
+                    pass
+            uow.save(drops)
+
+            logger.info('saved dungeon %s: %s inserts, %s updates', dungeon_seq, uow.inserted, uow.updated)
+
+
+def _by_key(items: List[SimpleSqlItem]) -> Dict[Any, SimpleSqlItem]:
+    """Indexes items by their KEY_COL value; like load_single_object, a key must be unique."""
+    result = {}
+    for item in items:
+        key = item.key_value()
+        if key in result:
+            raise ValueError('got too many results:', type(item).TABLE, key)
+        result[key] = item
+    return result
+
+
+def _by_list_key(items: List[SimpleSqlItem]) -> Dict[Any, List[SimpleSqlItem]]:
+    """Groups items by their LIST_COL value, keeping the order they were loaded in."""
+    result = {}
+    for item in items:
+        result.setdefault(getattr(item, type(item).LIST_COL), []).append(item)
+    return result
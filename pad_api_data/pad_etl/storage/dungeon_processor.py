@@ -4,6 +4,7 @@ import time
 
 from . import dungeon as dbdungeon
 from ..common.padguide_values import SpecialIcons
+from ..data import card as datacard
 from ..data import dungeon as datadungeon
 from ..processor import enemy_skillset
 from ..processor import enemy_skillset_processor
@@ -17,19 +18,19 @@ VERSION = 'dadguide 0.3'
 
 
 class ProcessedFloor(object):
-    def __init__(self, stage_count, example_waves, monster_id_to_card):
+    def __init__(self, stage_count, example_waves, monster_id_to_card, enemy_tables):
         self.stages = [ProcessedStage(idx + 1) for idx in range(stage_count)]
         self.invades = ProcessedStage(0)
 
         stage_groupings = defaultdict(list)
         for wave in example_waves:
             if wave.is_invade():
-                self.invades.add_wave_group([wave], monster_id_to_card)
+                self.invades.add_wave_group([wave], monster_id_to_card, enemy_tables)
             else:
                 stage_groupings[(wave.stage, wave.entry_id)].append(wave)
 
         for k, v in stage_groupings.items():
-            self.stages[k[0]].add_wave_group(v, monster_id_to_card)
+            self.stages[k[0]].add_wave_group(v, monster_id_to_card, enemy_tables)
 
         self.result_stages = []
         if self.invades.count > 0:
@@ -55,7 +56,7 @@ class ProcessedStage(object):
         self.spawn_to_count = defaultdict(int)
         self.spawns_per_wave = []
 
-    def add_wave_group(self, waves, monster_id_to_card):
+    def add_wave_group(self, waves, monster_id_to_card, enemy_tables):
         """A wave group represents all the spawns encountered on a stage instance."""
         self.count += 1
         self.spawns_per_wave.append(len(waves))
@@ -73,7 +74,7 @@ class ProcessedStage(object):
             self.spawn_to_slot[wave.monster_id].add(wave.slot)
             self.spawn_to_count[wave.monster_id] += 1
 
-            enemy_data = monster_id_to_card[wave.monster_id].enemy()
+            enemy_data = enemy_tables.enemy(monster_id_to_card[wave.monster_id])
             enemy_level = wave.monster_level
             coins += wave.get_coins()
             coins += enemy_data.coin.value_at(enemy_level)
@@ -157,6 +158,7 @@ def make_tree_from_cards(cards):
 def populate_dungeon(dungeon: dbdungeon.Dungeon,
                      jp_dungeon: datadungeon.Dungeon,
                      na_dungeon: datadungeon.Dungeon,
+                     enemy_tables: datacard.EnemyTableCache,
                      waves=[],
                      cards=[],
                      na_cards=[],
@@ -214,7 +216,8 @@ def populate_dungeon(dungeon: dbdungeon.Dungeon,
                            monster_id_to_card,
                            floor_text.get(idx + 1, ''),
                            monster_name_to_id,
-                           enemy_id_to_enemy)
+                           enemy_id_to_enemy,
+                           enemy_tables)
 
     dungeon.icon_seq = 0
     max_dungeon = dungeon.resolved_sub_dungeons[-1]
@@ -234,7 +237,8 @@ def update_sub_dungeon(sub_dungeon: dbdungeon.SubDungeon,
                        monster_id_to_card,
                        floor_text,
                        monster_name_to_id,
-                       enemy_id_to_enemy
+                       enemy_id_to_enemy,
+                       enemy_tables: datacard.EnemyTableCache
                        ):
     sub_dungeon.order_idx = jp_dungeon_floor.floor_number
     sub_dungeon.stage = jp_dungeon_floor.waves
@@ -244,7 +248,7 @@ def update_sub_dungeon(sub_dungeon: dbdungeon.SubDungeon,
     sub_dungeon.tsd_name_us = na_dungeon_floor.clean_name
     sub_dungeon.tstamp = int(time.time()) * 1000
 
-    processed_floor = ProcessedFloor(jp_dungeon_floor.waves, waves, monster_id_to_card)
+    processed_floor = ProcessedFloor(jp_dungeon_floor.waves, waves, monster_id_to_card, enemy_tables)
     result_stages = processed_floor.result_stages
 
     sub_dungeon.coin_max = int(sum([rs.coins_max for rs in result_stages]))
@@ -316,7 +320,7 @@ def update_sub_dungeon(sub_dungeon: dbdungeon.SubDungeon,
                 monster.monster_no = monster_id
                 sub_dungeon.resolved_dungeon_monsters.append(monster)
 
-            enemy_data = card.enemy()
+            enemy_data = enemy_tables.enemy(card)
             enemy_level = slot.monster_level
 
             # TODO: fix
@@ -35,6 +35,10 @@ class EggMonster(SimpleSqlItem):
             self, cols=['tet_seq', 'order_idx'], include_key=False)
         # TODO: add unique key to enforce
 
+    def exists_sql_params(self):
+        return sql_item.key_and_cols_compare_params(
+            self, cols=['tet_seq', 'order_idx'], include_key=False)
+
 
 class EggTitleType(Enum):
     """Type of title; controls how the row displays"""
@@ -105,6 +109,10 @@ class EggTitle(SimpleSqlItem):
             self, cols=['pad_machine_row', 'pad_machine_type', 'order_idx', 'server', 'tec_seq'], include_key=False)
         # TODO: add unique key to enforce
 
+    def exists_sql_params(self):
+        return sql_item.key_and_cols_compare_params(
+            self, cols=['pad_machine_row', 'pad_machine_type', 'order_idx', 'server', 'tec_seq'], include_key=False)
+
 
 class EggTitleLanguage(Enum):
     """Valid values for the 'language' field in EggTitleName.
@@ -141,6 +149,10 @@ class EggTitleName(SimpleSqlItem):
             self, cols=['tet_seq', 'language'], include_key=False)
         # TODO: add unique key to enforce
 
+    def exists_sql_params(self):
+        return sql_item.key_and_cols_compare_params(
+            self, cols=['tet_seq', 'language'], include_key=False)
+
     def uses_alternate_key_lookup(self):
         return True
 
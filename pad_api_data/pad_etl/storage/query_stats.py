@@ -0,0 +1,137 @@
+"""
+Collects timing, row counts and round trips for the statements DbWrapper runs.
+
+Every statement is attributed to the current phase (set by the caller, e.g.
+'cards' or 'news') and to its kind (SELECT, INSERT, ...). Per phase and kind
+this keeps a count, rows returned/affected, total and max time and a latency
+histogram; per phase it also counts the distinct statements after replacing
+literals with '?', which is what exposes loops that run the same query once
+per item. report()/save() produce a JSON summary.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import re
+from typing import Any, Dict, List
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is unbounded.
+HISTOGRAM_BUCKETS_MS = [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000]
+
+DEFAULT_PHASE = 'default'
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*(?:\?|%s)\s*,?)+\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+
+def statement_kind(sql: str) -> str:
+    """The leading keyword of a statement, e.g. SELECT."""
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+def fingerprint(sql: str) -> str:
+    """sql with literals replaced by '?', so repeated statements differing only in values group together."""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class KindStats(object):
+    """Totals for one kind of statement within a phase."""
+
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+
+    def record(self, seconds: float, rows: int):
+        self.count += 1
+        self.rows += rows
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+        ms = seconds * 1000
+        idx = 0
+        while idx < len(HISTOGRAM_BUCKETS_MS) and ms > HISTOGRAM_BUCKETS_MS[idx]:
+            idx += 1
+        self.histogram[idx] += 1
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'rows': self.rows,
+            'seconds': round(self.seconds, 6),
+            'max_ms': round(self.max_seconds * 1000, 3),
+            # Bucket upper bounds in ms with their counts; null is the unbounded last bucket
+            'histogram_ms': [[bound, n] for bound, n in zip(HISTOGRAM_BUCKETS_MS + [None], self.histogram)],
+        }
+
+
+class QueryStats(object):
+    """Statement statistics for a run, grouped by phase."""
+
+    def __init__(self, top_statements: int=20):
+        self.top_statements = top_statements
+        self.current_phase = DEFAULT_PHASE
+        # phase -> kind -> KindStats
+        self.kinds = defaultdict(lambda: defaultdict(KindStats))  # type: Dict[str, Dict[str, KindStats]]
+        # phase -> fingerprint -> [count, seconds]
+        self.statements = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))  # type: Dict[str, Dict[str, List]]
+
+    def set_phase(self, phase: str):
+        self.current_phase = phase
+
+    @contextmanager
+    def phase(self, phase: str):
+        """Attributes the statements run inside the block to phase."""
+        previous = self.current_phase
+        self.current_phase = phase
+        try:
+            yield
+        finally:
+            self.current_phase = previous
+
+    def record(self, sql: str, seconds: float, rows: int):
+        """Records one round trip."""
+        phase = self.current_phase
+        # Drivers report -1 when the row count isn't known; count those as 0
+        self.kinds[phase][statement_kind(sql)].record(seconds, max(rows or 0, 0))
+        entry = self.statements[phase][fingerprint(sql)]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def report(self) -> Dict[str, Any]:
+        phases = {}
+        total_count = 0
+        total_seconds = 0.0
+        for phase, kinds in self.kinds.items():
+            count = sum(k.count for k in kinds.values())
+            seconds = sum(k.seconds for k in kinds.values())
+            total_count += count
+            total_seconds += seconds
+
+            top = sorted(self.statements[phase].items(), key=lambda x: (-x[1][0], -x[1][1]))
+            phases[phase] = {
+                'round_trips': count,
+                'rows': sum(k.rows for k in kinds.values()),
+                'seconds': round(seconds, 6),
+                'kinds': {kind: k.to_json() for kind, k in kinds.items()},
+                'top_statements': [{'sql': sql, 'count': c, 'seconds': round(s, 6)}
+                                   for sql, (c, s) in top[:self.top_statements]],
+            }
+
+        return {
+            'round_trips': total_count,
+            'seconds': round(total_seconds, 6),
+            'phases': phases,
+        }
+
+    def save(self, output_file: str):
+        with open(output_file, 'w') as f:
+            json.dump(self.report(), f, indent=4, sort_keys=True)
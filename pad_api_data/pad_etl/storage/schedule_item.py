@@ -26,6 +26,24 @@ class EventType(Enum):
 
 
 class ScheduleItem(object):
+    TABLE = 'schedule_list'
+
+    # Columns written by insert_sql and by batched inserts
+    INSERT_COLUMNS = [
+        'open_timestamp', 'close_timestamp',
+        'close_date', 'close_hour', 'close_minute', 'close_weekday',
+        'dungeon_seq',
+        'event_seq',
+        'event_type',
+        'open_date', 'open_hour', 'open_minute', 'open_weekday',
+        'schedule_seq',
+        'server',
+        'server_open_date', 'server_open_hour',
+        'team_data',
+        'tstamp',
+        'url',
+    ]
+
     def __init__(self, merged_bonus: MergedBonus, event_id: int, dungeon_id: int):
         self.server = processor_util.normalize_pgserver(merged_bonus.server)
 
@@ -115,36 +133,7 @@ class ScheduleItem(object):
     def insert_sql(self, schedule_seq):
         self.schedule_seq = schedule_seq
 
-        sql = """
-            INSERT INTO schedule_list
-            (
-            `open_timestamp`, `close_timestamp`,
-            `close_date`, `close_hour`, `close_minute`, `close_weekday`,
-            `dungeon_seq`,
-            `event_seq`,
-            `event_type`,
-            `open_date`, `open_hour`, `open_minute`, `open_weekday`,
-            `schedule_seq`,
-            `server`,
-            `server_open_date`, `server_open_hour`,
-            `team_data`,
-            `tstamp`,
-            `url`)
-            VALUES
-            ({open_timestamp}, {close_timestamp},
-            {close_date}, {close_hour}, {close_minute}, {close_weekday}, {dungeon_seq},
-            {event_seq},
-            {event_type},
-            {open_date}, {open_hour}, {open_minute}, {open_weekday},
-            {schedule_seq},
-            {server},
-            {server_open_date}, {server_open_hour},
-            {team_data},
-            {tstamp},
-            {url});
-            """.format(**sql_item.object_to_sql_params(self))
-
-        return sql
+        return sql_item.generate_insert_sql(ScheduleItem.TABLE, ScheduleItem.INSERT_COLUMNS, self)
 
     def __repr__(self):
         return 'ScheduleItem({}/{} - {} {}->{})'.format(self.event_seq, self.dungeon_seq, self.group, self.open_date, self.close_date)
@@ -0,0 +1,134 @@
+"""
+Allocates *_seq primary keys for PadGuide tables that don't use auto-increment.
+
+Those tables used to get their next ID from `SELECT 1 + MAX(...)` followed by
+counting up locally, which is only safe when a single writer runs at a time.
+Instead, the next free value per table is kept in a small allocation table and
+each writer reserves a block of IDs with a single atomic UPDATE, using MySQL's
+LAST_INSERT_ID(expr) so the value it set comes back as the statement's insert id.
+
+The allocation table is created by bootstrap(), which has to run once at startup
+before any transaction is opened: CREATE TABLE is DDL, and MySQL implicitly
+commits the open transaction when it runs one. bootstrap() also seeds the row for
+each table in SEQUENCES from the table's current MAX, but only if the row is
+missing, so the MAX scan runs once per table rather than once per run.
+
+Every writer to the tables in SEQUENCES, including tools outside this ETL, must
+allocate IDs through the allocation table. A writer that inserts MAX + 1 will
+collide with IDs already reserved in another writer's block.
+
+Callers that know how many IDs they need up front should reserve() exactly that
+many. next_id() reserves blocks that start at one ID and double each time, up to
+block_size, so a run that only inserts a few rows doesn't skip a whole block.
+IDs in a block that end up unused are skipped, so sequences may have gaps.
+Dry runs never write, so they fall back to counting up from MAX locally.
+"""
+
+import logging
+from typing import Dict, Tuple
+
+from .db_util import DbWrapper
+
+logger = logging.getLogger('database')
+
+ALLOCATION_TABLE = 'etl_sequence'
+
+DEFAULT_BLOCK_SIZE = 100
+
+# table name -> (key column, value to start after if the table is empty)
+SEQUENCES = {
+    'awoken_skill_list': ('tma_seq', 20000),
+    'evo_material_list': ('tem_seq', 15000),
+    'evolution_list': ('tv_seq', 4000),
+    'news_list': ('tn_seq', 10000),
+    'schedule_list': ('schedule_seq', 30000),
+    'skill_list': ('ts_seq', 20000),
+}  # type: Dict[str, Tuple[str, int]]
+
+
+def create_allocation_table_sql():
+    return ('CREATE TABLE IF NOT EXISTS `{}` ('
+            '`table_name` varchar(64) NOT NULL PRIMARY KEY, '
+            '`next_value` bigint NOT NULL)').format(ALLOCATION_TABLE)
+
+
+def bootstrap(db_wrapper: DbWrapper):
+    """Creates the allocation table and any missing rows; call before opening any transaction."""
+    if db_wrapper._transaction_depth:
+        raise ValueError('{} has to be created outside of a transaction'.format(ALLOCATION_TABLE))
+    db_wrapper.insert_item(create_allocation_table_sql())
+    if db_wrapper.dry_run:
+        return
+
+    seeded = {row['table_name'] for row in db_wrapper.fetch_data(
+        'SELECT table_name FROM `{}`'.format(ALLOCATION_TABLE))}
+    for table_name, (key_col, min_value) in SEQUENCES.items():
+        if table_name in seeded:
+            continue
+        logger.info('seeding %s for %s', ALLOCATION_TABLE, table_name)
+        # Ignored if another writer created the row in the meantime
+        db_wrapper.insert_item(
+            'INSERT IGNORE INTO `{}` (table_name, next_value) SELECT %s, {}'.format(
+                ALLOCATION_TABLE, _next_after_max(table_name, key_col, min_value)),
+            (table_name,))
+
+
+def _next_after_max(table_name: str, key_col: str, min_value: int):
+    return '1 + COALESCE(MAX(CAST({} AS SIGNED)), {}) FROM {}'.format(key_col, min_value, table_name)
+
+
+class SequenceAllocator(object):
+    """Hands out primary keys for one table, reserving them in growing blocks of up to block_size."""
+
+    def __init__(self, db_wrapper: DbWrapper, table_name: str, key_col: str, min_value: int,
+                 block_size: int=DEFAULT_BLOCK_SIZE):
+        self.db_wrapper = db_wrapper
+        self.table_name = table_name
+        self.key_col = key_col
+        self.min_value = min_value
+        self.block_size = block_size
+
+        # The current block is [next_value, end_value)
+        self.next_value = 0
+        self.end_value = 0
+        # Size of the block next_id() reserves next
+        self.next_block_size = 1
+        # Next unreserved value, only used in dry runs
+        self._dry_run_value = None
+
+    def next_id(self) -> int:
+        if self.next_value >= self.end_value:
+            self.next_value, self.end_value = self.reserve(self.next_block_size)
+            self.next_block_size = min(self.next_block_size * 2, self.block_size)
+        value = self.next_value
+        self.next_value += 1
+        return value
+
+    def reserve(self, count: int) -> Tuple[int, int]:
+        """Reserves count consecutive IDs, returning the range [start, end)."""
+        if self.db_wrapper.dry_run:
+            if self._dry_run_value is None:
+                self._dry_run_value = self.db_wrapper.get_single_value(
+                    'SELECT ' + _next_after_max(self.table_name, self.key_col, self.min_value), op=int)
+            start = self._dry_run_value
+            self._dry_run_value += count
+            return start, start + count
+
+        # The insert id is the value passed to LAST_INSERT_ID(), or 0 if no row matched
+        end = self.db_wrapper.insert_item(
+            'UPDATE `{}` SET next_value = LAST_INSERT_ID(next_value + %s) WHERE table_name = %s'.format(
+                ALLOCATION_TABLE),
+            (count, self.table_name))
+        if not end:
+            raise ValueError('no {} row for {}; run sequence.bootstrap() first'.format(
+                ALLOCATION_TABLE, self.table_name))
+        logger.info('reserved %s ids for %s starting at %s', count, self.table_name, end - count)
+        return end - count, end
+
+
+def allocator_for(db_wrapper: DbWrapper, table_name: str, block_size: int=DEFAULT_BLOCK_SIZE):
+    """Builds a SequenceAllocator for one of the tables in SEQUENCES."""
+    if table_name not in SEQUENCES:
+        raise ValueError('no sequence configured for {}'.format(table_name))
+    key_col, min_value = SEQUENCES[table_name]
+    return SequenceAllocator(db_wrapper, table_name, key_col, min_value, block_size=block_size)
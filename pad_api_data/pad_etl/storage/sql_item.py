@@ -6,41 +6,103 @@ import time
 from enum import Enum
 
 
+class ClassMeta(object):
+    """Column metadata for one class of SqlItem (or any object written to the DB), computed once."""
+
+    def __init__(self, cls):
+        mappings = getattr(cls, 'COL_MAPPINGS', {})
+        # DB column name -> attribute name, and back
+        self.col_to_attr = dict(mappings)
+        self.attr_to_col = {v: k for k, v in mappings.items()}
+        # (attribute names, discarded key, remove_cols, add_cols) -> columns; see full_columns
+        self.full_columns = {}
+
+
+_class_meta = {}
+
+
+def class_meta(cls) -> ClassMeta:
+    meta = _class_meta.get(cls)
+    if meta is None:
+        meta = ClassMeta(cls)
+        _class_meta[cls] = meta
+    return meta
+
+
 def object_to_sql_params(obj):
     d = obj if type(obj) == dict else obj.__dict__
-    # Defensive copy since we're updating this dict
-    d = dict(d)
-    d = process_col_mappings(type(obj), d, reverse=True)
+    attr_to_col = class_meta(type(obj)).attr_to_col
     new_d = {}
     for k, v in d.items():
-        new_val = value_to_sql_param(v)
-        if new_val is not None:
-            new_d[k] = new_val
+        formatter = _SQL_FORMATTERS.get(type(v))
+        if formatter is not None:
+            new_d[attr_to_col.get(k, k)] = formatter(v)
     return new_d
 
 
+def _str_to_sql_param(v):
+    clean_v = v.replace("'", r"''")
+    return "'{}'".format(clean_v)
+
+
+# Exact type -> SQL literal formatter; unsupported types are left out of the params.
+_SQL_FORMATTERS = {
+    type(None): lambda v: 'NULL',
+    str: _str_to_sql_param,
+    int: '{}'.format,
+    float: '{}'.format,
+    decimal.Decimal: '{}'.format,
+    date: lambda v: "'{}'".format(v.isoformat()),
+    datetime: lambda v: "'{}'".format(v.replace(tzinfo=None).isoformat()),
+    bool: str,
+}
+
+
 def value_to_sql_param(v):
-    if v is None:
-        return 'NULL'
-    elif type(v) == str:
-        clean_v = v.replace("'", r"''")
-        return "'{}'".format(clean_v)
-    elif type(v) in (int, float, decimal.Decimal):
-        return '{}'.format(v)
-    elif type(v) in [date]:
-        return "'{}'".format(v.isoformat())
+    formatter = _SQL_FORMATTERS.get(type(v))
+    return formatter(v) if formatter is not None else None
+
+
+def value_to_param(v):
+    """Converts a value for driver-side binding; the parameterized counterpart of value_to_sql_param."""
+    if v is None or type(v) in (str, int, float, decimal.Decimal, date, bool):
+        return v
     elif type(v) in [datetime]:
-        return "'{}'".format(v.replace(tzinfo=None).isoformat())
-    elif type(v) in [bool]:
-        return str(v)
+        return v.replace(tzinfo=None)
     else:
-        return None
+        raise ValueError('unsupported sql value: {}'.format(repr(v)))
+
+
+def object_to_params(obj, cols):
+    """Returns the values of cols (column names) on obj, as a tuple to bind against a template."""
+    d = obj if type(obj) == dict else obj.__dict__
+    col_to_attr = class_meta(type(obj)).col_to_attr
+    return tuple(value_to_param(d[col_to_attr.get(c, c)]) for c in cols)
+
+
+# (class, statement kind, columns) -> SQL template; every item of a class with the same
+# columns shares one template, so they're only built once.
+_sql_templates = {}
+
+
+def _template(obj, kind, cols, build_fn):
+    cache_key = (type(obj), kind, tuple(cols))
+    sql = _sql_templates.get(cache_key)
+    if sql is None:
+        sql = build_fn()
+        _sql_templates[cache_key] = sql
+    return sql
 
 
 def _col_compare(col):
     return col + ' = ' + _col_value_ref(col)
 
 
+def _col_param_compare(col):
+    # NULL-safe equality, so one template works whether or not the value is NULL
+    return col + ' <=> %s'
+
+
 def _col_value_ref(col):
     return '{' + col + '}'
 
@@ -54,33 +116,109 @@ def _tbl_name_ref(table_name):
 
 
 def generate_insert_sql(table_name, cols, item):
-    sql = 'INSERT INTO {}'.format(_tbl_name_ref(table_name))
-    sql += ' (' + ', '.join(map(_col_name_ref, cols)) + ')'
-    sql += ' VALUES (' + ', '.join(map(_col_value_ref, cols)) + ')'
-    return sql.format(**object_to_sql_params(item))
+    def build():
+        sql = 'INSERT INTO {}'.format(_tbl_name_ref(table_name))
+        sql += ' (' + ', '.join(map(_col_name_ref, cols)) + ')'
+        sql += ' VALUES (' + ', '.join(map(_col_value_ref, cols)) + ')'
+        return sql
+
+    return _template(item, ('insert_format', table_name), cols, build).format(**object_to_sql_params(item))
+
+
+def generate_insert_sql_params(table_name, cols, item):
+    def build():
+        sql = 'INSERT INTO {}'.format(_tbl_name_ref(table_name))
+        sql += ' (' + ', '.join(map(_col_name_ref, cols)) + ')'
+        sql += ' VALUES (' + ', '.join(['%s'] * len(cols)) + ')'
+        return sql
+
+    return _template(item, ('insert', table_name), cols, build), object_to_params(item, cols)
 
 
 # This could maybe move to a class method on SqlItem?
 # Fix usage in load_x_object in db_util.
 def process_col_mappings(obj_type, d, reverse=False):
-    if hasattr(obj_type, 'COL_MAPPINGS'):
-        mappings = obj_type.COL_MAPPINGS
-        if reverse:
-            mappings = {v: k for k, v in mappings.items()}
-
-        for k, v in mappings.items():
-            d[v] = d[k]
-            d.pop(k)
+    meta = class_meta(obj_type)
+    mappings = meta.attr_to_col if reverse else meta.col_to_attr
+    for k, v in mappings.items():
+        d[v] = d[k]
+        d.pop(k)
     return d
 
 
+# Stands in for NaN, which never compares equal to itself as a Decimal
+_NAN = 'NaN'
+
+
+def is_number(v):
+    return type(v) in (bool, int, float, decimal.Decimal)
+
+
+def normalize_value(v, numeric=False):
+    """Converts a python or DB value into a form that compares equal when MySQL would.
+
+    Numbers become Decimals so that 1, 1.0 and Decimal('1.00') match. Strings are only
+    converted when numeric is set, i.e. when they're compared against a number or come
+    from a numeric column, as MySQL does; otherwise they compare like the default
+    collation: case-insensitive, ignoring trailing spaces.
+    """
+    if v is None:
+        return None
+    elif type(v) == bool:
+        return decimal.Decimal(int(v))
+    elif type(v) in (int, float, decimal.Decimal):
+        d = decimal.Decimal(str(v))
+        return _NAN if d.is_nan() else d
+    elif type(v) == datetime:
+        return v.replace(tzinfo=None).isoformat()
+    elif type(v) == date:
+        return v.isoformat()
+
+    s = str(v)
+    if numeric:
+        try:
+            d = decimal.Decimal(s.strip())
+            if not d.is_nan():
+                return d
+        except decimal.InvalidOperation:
+            pass
+    return s.rstrip(' ').casefold()
+
+
+def values_match(value, db_value):
+    """True if MySQL would consider the python value equal to the stored db_value."""
+    numeric = is_number(value) or is_number(db_value)
+    return normalize_value(value, numeric) == normalize_value(db_value, numeric)
+
+
+def item_values(item):
+    """The column name -> value dict that would be written for item."""
+    d = {k: v for k, v in vars(item).items() if not k.startswith('_')}
+    return process_col_mappings(type(item), d, reverse=True)
+
+
 def full_columns(o: 'SqlItem', remove_cols=[], add_cols=[]):
+    """Every column of o except the local key, tstamp, resolved_ and _private fields.
+
+    Computed once per class and attribute layout; the returned list is shared, don't modify it.
+    """
+    discarded_key = o._key() if o.uses_local_primary_key() else None
+    cache_key = (tuple(vars(o)), discarded_key, tuple(remove_cols), tuple(add_cols))
+    cache = class_meta(type(o)).full_columns
+    cols = cache.get(cache_key)
+    if cols is None:
+        cols = _compute_full_columns(o, remove_cols, add_cols)
+        cache[cache_key] = cols
+    return cols
+
+
+def _compute_full_columns(o: 'SqlItem', remove_cols, add_cols):
     cols = set(vars(o).keys())
     if o.uses_local_primary_key():
         cols.discard(o._key())
     cols.discard('tstamp')
     # Do something about tstamp in SqlItem insert or update
-    cols = set([x for x in cols if not x.startswith('resolved')])
+    cols = set([x for x in cols if not x.startswith('resolved') and not x.startswith('_')])
     cols = cols.difference(remove_cols)
     cols = cols.union(add_cols)
 
@@ -97,7 +235,7 @@ def dump_helper(x):
     if isinstance(x, Enum):
         return str(x)
     elif hasattr(x, '__dict__'):
-        return vars(x)
+        return {k: v for k, v in vars(x).items() if not k.startswith('_')}
     else:
         return repr(x)
 
@@ -110,15 +248,69 @@ def key_and_cols_compare(item: 'SqlItem', cols=[], include_key=True):
     if include_key and item._key() not in cols:
         cols = [item._key()] + cols
 
-    sql = 'SELECT {} FROM {} WHERE'.format(item._key(), item._table())
-    sql += ' ' + ' AND '.join(map(_col_compare, cols))
-    formatted_sql = sql.format(**object_to_sql_params(item))
+    def build():
+        sql = 'SELECT {} FROM {} WHERE'.format(item._key(), item._table())
+        return sql + ' ' + ' AND '.join(map(_col_compare, cols))
+
+    formatted_sql = _template(item, 'compare_format', cols, build).format(**object_to_sql_params(item))
     fixed_sql = formatted_sql.replace('= NULL', 'is NULL')
 
     return fixed_sql
 
 
+def key_and_cols_compare_params(item: 'SqlItem', cols=[], include_key=True):
+    if include_key and item._key() not in cols:
+        cols = [item._key()] + cols
+
+    def build():
+        sql = 'SELECT {} FROM {} WHERE'.format(item._key(), item._table())
+        return sql + ' ' + ' AND '.join(map(_col_param_compare, cols))
+
+    return _template(item, 'compare', cols, build), object_to_params(item, cols)
+
+
 class SqlItem(object):
+    """Base class for rows that can be looked up, inserted and updated.
+
+    Each *_sql method has a *_sql_params counterpart that returns a fixed SQL template
+    for the class plus the tuple of values to bind to it. Subclasses that override one
+    of the *_sql methods without overriding its *_sql_params counterpart get the
+    formatted statement with no params instead.
+
+    Change tracking is optional: after mark_clean() the item remembers its update column
+    values as stored in the DB, and is_dirty() can tell whether an UPDATE is needed
+    without querying. Items that were never marked report None (unknown).
+    """
+
+    # Key and update column -> value as last loaded from / written to the DB
+    _loaded_values = None
+
+    def mark_clean(self, row=None):
+        """Snapshots the key and update columns as stored in the DB.
+
+        row is the DB row (column name -> value) the item was built from; by default the
+        item's current values are taken, e.g. right after it was written.
+        """
+        cols = [self._key()] + (self._update_columns() or [])
+        values = row if row is not None else item_values(self)
+        self._loaded_values = {c: values.get(c) for c in cols}
+
+    def tracks_changes(self):
+        """True if mark_clean() was called and the key still points at the same row."""
+        loaded = self._loaded_values
+        return loaded is not None and values_match(self.key_value(), loaded[self._key()])
+
+    def is_dirty(self):
+        """True if an update column changed since mark_clean(), or None if not tracked."""
+        if not self.tracks_changes():
+            return None
+        update_cols = self._update_columns()
+        if update_cols is None:
+            return False
+        loaded = self._loaded_values
+        values = item_values(self)
+        return any(c not in loaded or not values_match(values.get(c), loaded[c]) for c in update_cols)
+
     def key_value(self):
         return getattr(self, self._key()) if self._key() else None
 
@@ -166,10 +358,13 @@ class SqlItem(object):
                 cols = cols + ['tstamp']
             self.tstamp = time.time() * 1000
 
-        sql = 'UPDATE {}'.format(self._table())
-        sql += ' SET ' + ', '.join(map(_col_compare, cols))
-        sql += ' WHERE ' + _col_compare(self._key())
-        return sql.format(**object_to_sql_params(self))
+        def build():
+            sql = 'UPDATE {}'.format(self._table())
+            sql += ' SET ' + ', '.join(map(_col_compare, cols))
+            sql += ' WHERE ' + _col_compare(self._key())
+            return sql
+
+        return _template(self, 'update_format', cols, build).format(**object_to_sql_params(self))
 
     def insert_sql(self):
         cols = self._insert_columns()
@@ -179,6 +374,61 @@ class SqlItem(object):
             self.tstamp = time.time() * 1000
         return generate_insert_sql(self._table(), cols, self)
 
+    def _overrides_sql(self, sql_method, params_method):
+        cls = type(self)
+        return (getattr(cls, sql_method) is not getattr(SqlItem, sql_method) and
+                getattr(cls, params_method) is getattr(SqlItem, params_method))
+
+    def exists_sql_params(self):
+        if self._overrides_sql('exists_sql', 'exists_sql_params'):
+            return self.exists_sql(), None
+        return key_and_cols_compare_params(self)
+
+    def needs_update_sql_params(self, include_key=True):
+        if self._overrides_sql('needs_update_sql', 'needs_update_sql_params'):
+            sql = self.needs_update_sql(include_key=include_key)
+            return (sql, None) if sql else None
+
+        update_cols = self._update_columns()
+        if update_cols is None:
+            return None
+
+        return key_and_cols_compare_params(self, cols=update_cols, include_key=include_key)
+
+    def update_sql_params(self):
+        if self._overrides_sql('update_sql', 'update_sql_params'):
+            sql = self.update_sql()
+            return (sql, None) if sql else None
+
+        cols = self._update_columns()
+        if not cols:
+            return None  # Update not supported
+
+        # If an item is timestamped, modify the timestamp on every update
+        if hasattr(self, 'tstamp'):
+            if 'tstamp' not in cols:
+                cols = cols + ['tstamp']
+            self.tstamp = time.time() * 1000
+
+        def build():
+            sql = 'UPDATE {}'.format(self._table())
+            sql += ' SET ' + ', '.join(map(lambda c: c + ' = %s', cols))
+            sql += ' WHERE ' + self._key() + ' = %s'
+            return sql
+
+        return _template(self, 'update', cols, build), object_to_params(self, list(cols) + [self._key()])
+
+    def insert_sql_params(self):
+        if self._overrides_sql('insert_sql', 'insert_sql_params'):
+            return self.insert_sql(), None
+
+        cols = self._insert_columns()
+        if hasattr(self, 'tstamp'):
+            if 'tstamp' not in cols:
+                cols = cols + ['tstamp']
+            self.tstamp = time.time() * 1000
+        return generate_insert_sql_params(self._table(), list(cols), self)
+
     def set_key_value(self, key_value):
         setattr(self, self._key(), key_value)
 
@@ -212,4 +462,4 @@ class SimpleSqlItem(SqlItem):
         return full_columns(self)
 
     def _update_columns(self):
-        return full_columns(self, remove_cols=[self._key])
+        return full_columns(self, remove_cols=[self._key()])
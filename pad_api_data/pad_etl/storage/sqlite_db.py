@@ -0,0 +1,264 @@
+"""
+SQLite stand-in for the PadGuide MySQL database.
+
+SqliteConnection implements the small part of the pymysql connection/cursor
+API that DbWrapper uses (dict rows, execute/executemany, lastrowid, explicit
+transactions), and rewrites the MySQL-specific syntax the ETL emits into its
+SQLite equivalent. Together with bootstrap_schema this lets the whole
+pipeline run against a local file (or :memory:) for benchmarking and
+regression testing, with no MySQL server.
+
+Only the syntax the ETL actually uses is translated; anything else that
+SQLite doesn't accept raises as usual. Dates are stored as ISO strings.
+"""
+
+from datetime import date, datetime
+import decimal
+import functools
+import logging
+import re
+import sqlite3
+import time
+from typing import Any, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger('database')
+
+# table name -> (primary key column, other columns). Covers the tables the ETL reads or writes.
+SCHEMA = {
+    'awoken_skill_list': ('tma_seq', ['del_yn', 'is_super', 'monster_no', 'order_idx', 'tstamp', 'ts_seq']),
+    'dungeon_list': ('dungeon_seq', ['app_version', 'comment_jp', 'comment_kr', 'comment_us', 'dungeon_type',
+                                     'icon_seq', 'name_jp', 'name_kr', 'name_us', 'order_idx', 'show_yn',
+                                     'tdt_seq', 'tstamp']),
+    'dungeon_monster_drop_list': ('tdmd_seq', ['monster_no', 'order_idx', 'status', 'tdm_seq', 'tstamp']),
+    'dungeon_monster_list': ('tdm_seq', ['amount', 'atk', 'comment_jp', 'comment_kr', 'comment_us', 'def',
+                                         'drop_no', 'dungeon_seq', 'floor', 'hp', 'monster_no', 'order_idx',
+                                         'tsd_seq', 'tstamp', 'turn']),
+    'dungeon_skill_damage_list': ('tds_seq', ['damage', 'tstamp']),
+    'dungeon_type_list': ('tdt_seq', ['order_idx', 'tdt_name_jp', 'tdt_name_kr', 'tdt_name_us', 'tstamp']),
+    'egg_monster_list': ('tem_seq', ['del_yn', 'monster_no', 'order_idx', 'tet_seq', 'tstamp']),
+    'egg_title_list': ('tet_seq', ['del_yn', 'end_date', 'order_idx', 'pad_machine_row', 'pad_machine_type',
+                                   'server', 'show_yn', 'start_date', 'tec_seq', 'tstamp', 'type']),
+    'egg_title_name_list': ('tetn_seq', ['del_yn', 'language', 'name', 'tet_seq', 'tstamp']),
+    'etl_dungeon_ignore': ('pad_dungeon_id', []),
+    'etl_dungeon_map': ('pad_dungeon_id', ['dungeon_seq']),
+    'event_list': ('event_seq', ['event_name_jp', 'event_name_kr', 'event_name_us', 'tstamp']),
+    'evo_material_list': ('tem_seq', ['monster_no', 'order_idx', 'tstamp', 'tv_seq']),
+    'evolution_list': ('tv_seq', ['monster_no', 'to_no', 'tstamp', 'tv_type']),
+    'get_timestamp': ('internal_table', ['tstamp']),
+    'icon_list': ('icon_seq', ['icon_url', 'tstamp']),
+    'monster_add_info_list': ('monster_no', ['extra_val1', 'sub_type', 'tstamp']),
+    'monster_info_list': ('monster_no', ['fodder_exp', 'history_jp', 'history_kr', 'history_us', 'on_kr',
+                                         'on_us', 'pal_egg', 'rare_egg', 'sell_price', 'tsr_seq', 'tstamp']),
+    'monster_list': ('monster_no', ['app_version', 'atk_max', 'atk_min', 'comment_jp', 'comment_kr',
+                                    'comment_us', 'cost', 'exp', 'hp_max', 'hp_min', 'level', 'limit_mult',
+                                    'monster_no_jp', 'monster_no_kr', 'monster_no_us', 'pronunciation_jp',
+                                    'rarity', 'ratio_atk', 'ratio_hp', 'ratio_rcv', 'rcv_max', 'rcv_min',
+                                    'reg_date', 'ta_seq', 'ta_seq_sub', 'te_seq', 'tm_name_jp', 'tm_name_kr',
+                                    'tm_name_us', 'tstamp', 'ts_seq_leader', 'ts_seq_skill', 'tt_seq',
+                                    'tt_seq_sub']),
+    'monster_price_list': ('monster_no', ['buy_price', 'sell_price', 'tstamp']),
+    'news_list': ('tn_seq', ['del_yn', 'os_type', 'server', 'title_jp', 'title_kr', 'title_us', 'tstamp',
+                             'url_jp', 'url_kr', 'url_us']),
+    'schedule_list': ('schedule_seq', ['close_date', 'close_hour', 'close_minute', 'close_timestamp',
+                                       'close_weekday', 'dungeon_seq', 'event_seq', 'event_type', 'open_date',
+                                       'open_hour', 'open_minute', 'open_timestamp', 'open_weekday', 'server',
+                                       'server_open_date', 'server_open_hour', 'team_data', 'tstamp', 'url']),
+    'skill_data_list': ('ts_seq', ['data1', 'data2', 'data3', 'data4', 'data5', 'data6', 'tstamp',
+                                   'type_data']),
+    'skill_leader_data_list': ('ts_seq', ['leader_data', 'tstamp']),
+    'skill_list': ('ts_seq', ['mag_atk', 'mag_hp', 'mag_rcv', 'order_idx', 'reduce_dmg', 'rta_seq_1',
+                              'rta_seq_2', 'search_data', 't_condition', 'ta_seq_1', 'ta_seq_2', 'ts_desc_jp',
+                              'ts_desc_kr', 'ts_desc_us', 'ts_desc_us_calculated', 'ts_name_jp', 'ts_name_kr',
+                              'ts_name_us', 'tstamp', 'tt_seq_1', 'tt_seq_2', 'turn_max', 'turn_min']),
+    'sub_dungeon_list': ('tsd_seq', ['coin_max', 'coin_min', 'dungeon_seq', 'exp_max', 'exp_min', 'order_idx',
+                                     'stage', 'stamina', 'tsd_name_jp', 'tsd_name_kr', 'tsd_name_us', 'tstamp']),
+    'sub_dungeon_point_list': ('tsd_seq', ['tot_point', 'tstamp']),
+    'sub_dungeon_reward_list': ('tsd_seq', ['data', 'tstamp']),
+    'sub_dungeon_score_list': ('tsd_seq', ['score', 'tstamp']),
+    'wave_data': ('id', ['dungeon_id', 'drop_monster_id', 'drop_monster_level', 'entry_id', 'floor_id',
+                         'friend_id', 'leader_id', 'monster_id', 'monster_level', 'plus_amount', 'pull_id',
+                         'pull_time', 'server', 'slot', 'spawn_type', 'stage']),
+}  # type: Dict[str, Tuple[str, List[str]]]
+
+# Keys that aren't numeric, so can't be INTEGER PRIMARY KEY
+_TEXT_KEYS = {'get_timestamp'}
+
+
+def create_table_sql(table_name: str) -> str:
+    key_col, cols = SCHEMA[table_name]
+    key_type = 'TEXT PRIMARY KEY' if table_name in _TEXT_KEYS else 'INTEGER PRIMARY KEY'
+    col_defs = ['`{}` {}'.format(key_col, key_type)] + ['`{}`'.format(c) for c in cols]
+    return 'CREATE TABLE IF NOT EXISTS `{}` ({})'.format(table_name, ', '.join(col_defs))
+
+
+def bootstrap_schema(connection: 'SqliteConnection'):
+    """Creates every table in SCHEMA that doesn't exist yet.
+
+    get_timestamp gets a row for each *_list table, like the real one has.
+    """
+    db = connection.db
+    for table_name in sorted(SCHEMA):
+        db.execute(create_table_sql(table_name))
+    for table_name in sorted(SCHEMA):
+        if table_name.endswith('_list'):
+            db.execute('INSERT OR IGNORE INTO get_timestamp (internal_table, tstamp) VALUES (?, 0)',
+                       (table_name[:-len('_list')].upper(),))
+
+
+_SIMPLE_REWRITES = [
+    (re.compile(r'\bAS\s+SIGNED\b', re.IGNORECASE), 'AS INTEGER'),
+    (re.compile(r'\bINSERT\s+IGNORE\b', re.IGNORECASE), 'INSERT OR IGNORE'),
+    (re.compile(r'<=>'), 'IS'),
+]
+
+# UPDATE t AS a INNER JOIN (...) AS b ON <cond> SET <assignments>
+_UPDATE_JOIN = re.compile(
+    r'^\s*UPDATE\s+(\w+)\s+AS\s+(\w+)\s+INNER\s+JOIN\s+(\(.*\))\s+AS\s+(\w+)\s+ON\s+(.*?)\s+SET\s+(.*)$',
+    re.IGNORECASE | re.DOTALL)
+
+_ON_DUPLICATE_KEY = re.compile(r'\bON\s+DUPLICATE\s+KEY\s+UPDATE\b', re.IGNORECASE)
+_VALUES_REF = re.compile(r'\bVALUES\s*\((`?\w+`?)\)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=4096)
+def translate_sql(sql: str, parameterized: bool) -> str:
+    """Rewrites a MySQL statement from the ETL into SQLite syntax."""
+    for pattern, replacement in _SIMPLE_REWRITES:
+        sql = pattern.sub(replacement, sql)
+
+    # SQLite 3.33+ spells a joined update as UPDATE ... SET ... FROM ... WHERE
+    sql = _UPDATE_JOIN.sub(r'UPDATE \1 AS \2 SET \6 FROM \3 AS \4 WHERE \5', sql)
+
+    parts = _ON_DUPLICATE_KEY.split(sql, maxsplit=1)
+    if len(parts) == 2:
+        # col = VALUES(col) -> col = excluded.col; needs SQLite 3.35+ for the missing conflict target
+        sql = parts[0] + 'ON CONFLICT DO UPDATE SET' + _VALUES_REF.sub(r'excluded.\1', parts[1])
+
+    if parameterized:
+        # pymysql style format markers -> qmark; %% is a literal percent
+        sql = sql.replace('%s', '?').replace('%%', '%')
+    return sql
+
+
+def _is_insert(sql: str) -> bool:
+    return sql.lstrip()[:6].upper() == 'INSERT'
+
+
+def _to_sqlite_param(v: Any) -> Any:
+    if type(v) == decimal.Decimal:
+        return str(v)
+    elif type(v) == datetime:
+        # Same format as the literals sql_item writes, so stored dates compare consistently
+        return v.replace(tzinfo=None).isoformat()
+    elif type(v) == date:
+        return v.isoformat()
+    elif type(v) == bool:
+        return int(v)
+    return v
+
+
+class SqliteCursor(object):
+    """The parts of a pymysql DictCursor that DbWrapper uses."""
+
+    def __init__(self, connection: 'SqliteConnection'):
+        self.connection = connection
+        self.rows = []  # type: List[Dict[str, Any]]
+        self.lastrowid = None
+        self.rowcount = -1
+        self._is_insert = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def execute(self, sql: str, params: Sequence[Any]=None) -> int:
+        """Returns the number of rows fetched or affected, like pymysql."""
+        self._is_insert = _is_insert(sql)
+        self.connection.insert_id_expr = None
+        db_cursor = self.connection.db.cursor()
+        if params is None:
+            db_cursor.execute(translate_sql(sql, False))
+        else:
+            db_cursor.execute(translate_sql(sql, True), [_to_sqlite_param(p) for p in params])
+        return self._read_result(db_cursor)
+
+    def executemany(self, sql: str, rows: List[Sequence[Any]]) -> int:
+        self._is_insert = _is_insert(sql)
+        self.connection.insert_id_expr = None
+        db_cursor = self.connection.db.cursor()
+        db_cursor.executemany(translate_sql(sql, True),
+                              [[_to_sqlite_param(p) for p in row] for row in rows])
+        return self._read_result(db_cursor)
+
+    def _read_result(self, db_cursor) -> int:
+        if db_cursor.description:
+            cols = [d[0] for d in db_cursor.description]
+            self.rows = [dict(zip(cols, r)) for r in db_cursor.fetchall()]
+            self.rowcount = len(self.rows)
+        else:
+            self.rows = []
+            self.rowcount = db_cursor.rowcount
+            # sqlite reports the connection's last inserted rowid even after other statements
+            if db_cursor.lastrowid and self._is_insert:
+                self.lastrowid = db_cursor.lastrowid
+                self.connection.last_insert_id = db_cursor.lastrowid
+            elif not self._is_insert:
+                # MySQL reports LAST_INSERT_ID(expr) from any statement as its insert id, else 0
+                self.lastrowid = self.connection.insert_id_expr or 0
+        return self.rowcount
+
+    def fetchall(self) -> List[Dict[str, Any]]:
+        return self.rows
+
+    def fetchone(self) -> Dict[str, Any]:
+        return self.rows[0] if self.rows else None
+
+
+class SqliteConnection(object):
+    """A pymysql-like connection to an SQLite database; autocommits outside begin/commit."""
+
+    def __init__(self, path: str=':memory:'):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.last_insert_id = 0
+        # Set if the running statement called LAST_INSERT_ID(expr)
+        self.insert_id_expr = None
+        self._register_functions()
+
+    def _register_functions(self):
+        def last_insert_id(*args):
+            # LAST_INSERT_ID(expr) stores expr for the next LAST_INSERT_ID(), as in MySQL
+            if args:
+                self.last_insert_id = args[0]
+                self.insert_id_expr = args[0]
+            return self.last_insert_id
+
+        self.db.create_function('LAST_INSERT_ID', -1, last_insert_id)
+        self.db.create_function('UNIX_TIMESTAMP', 0, lambda: int(time.time()))
+        self.db.create_function('NOW', 0, lambda: datetime.utcnow().replace(microsecond=0).isoformat())
+
+    def cursor(self) -> SqliteCursor:
+        return SqliteCursor(self)
+
+    def begin(self):
+        self.db.execute('BEGIN')
+
+    def commit(self):
+        if self.db.in_transaction:
+            self.db.execute('COMMIT')
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.db.execute('ROLLBACK')
+
+    def close(self):
+        self.db.close()
+
+
+def connect(db_config: Dict[str, Any]) -> SqliteConnection:
+    """Opens db_config['path'] (default in-memory); creates the schema unless 'bootstrap' is false."""
+    connection = SqliteConnection(db_config.get('path', ':memory:'))
+    if db_config.get('bootstrap', True):
+        bootstrap_schema(connection)
+    return connection
@@ -0,0 +1,134 @@
+"""
+In-memory copies of PadGuide tables, for diffing SqlItems locally.
+
+The card diff normally checks every item against MySQL with one or two SELECTs
+(exists_sql / needs_update_sql, plus lookups by value). A TableSnapshot reads
+the whole table once instead; existence and change checks are then done
+against the local copy, and only the INSERT/UPDATE statements that are
+actually needed get sent. Writes have to be recorded back into the snapshot
+(store/store_item) so that later lookups in the same run see them, as they
+would when querying the database.
+"""
+
+import logging
+from typing import Any, Dict, List, Tuple
+
+from .db_util import DbWrapper, _row_to_object
+from .sql_item import SqlItem, _tbl_name_ref, is_number, item_values, normalize_value, values_match
+
+logger = logging.getLogger('database')
+
+
+def _row_key(values: Dict[str, Any], cols: Tuple[str, ...], numeric: Tuple[bool, ...]) -> Tuple:
+    return tuple(normalize_value(values.get(c), n) for c, n in zip(cols, numeric))
+
+
+class TableSnapshot(object):
+    """Every row of a table, with lazily built indexes over any set of columns."""
+
+    def __init__(self, db_wrapper: DbWrapper, table_name: str, key_col: str, rows: List[Dict[str, Any]]=None):
+        """rows, if set, are the already fetched rows to use instead of the whole table."""
+        self.table_name = table_name
+        self.key_col = key_col
+        if rows is None:
+            rows = db_wrapper.fetch_data('SELECT * FROM {}'.format(_tbl_name_ref(table_name)))
+            logger.info('Loaded %s rows from %s', len(rows), table_name)
+        self.rows = rows
+        # (sorted column names, per column whether it compares numerically) -> {normalized values: row}
+        self._indexes = {}  # type: Dict[Tuple[Tuple[str, ...], Tuple[bool, ...]], Dict[Tuple, Dict[str, Any]]]
+        # column name -> whether the DB returns numbers for it
+        self._numeric_cols = {}  # type: Dict[str, bool]
+
+    def _is_numeric_col(self, col: str) -> bool:
+        numeric = self._numeric_cols.get(col)
+        if numeric is None:
+            numeric = any(is_number(row.get(col)) for row in self.rows)
+            self._numeric_cols[col] = numeric
+        return numeric
+
+    def _index(self, cols: Tuple[str, ...], numeric: Tuple[bool, ...]) -> Dict[Tuple, Dict[str, Any]]:
+        index = self._indexes.get((cols, numeric))
+        if index is None:
+            index = {}
+            for row in self.rows:
+                # Keep the first row for duplicated values, like a single row fetch would
+                index.setdefault(_row_key(row, cols, numeric), row)
+            self._indexes[(cols, numeric)] = index
+        return index
+
+    def find(self, **col_values) -> Dict[str, Any]:
+        """Returns the row matching all the given column values, or None."""
+        cols = tuple(sorted(col_values.keys()))
+        # Strings are compared as numbers against numbers or numeric columns, like MySQL does
+        numeric = tuple(is_number(col_values[c]) or self._is_numeric_col(c) for c in cols)
+        return self._index(cols, numeric).get(_row_key(col_values, cols, numeric))
+
+    def get(self, key_value) -> Dict[str, Any]:
+        """Returns the row with the given primary key, or None."""
+        return self.find(**{self.key_col: key_value})
+
+    def has_item(self, item: SqlItem) -> bool:
+        """Equivalent to checking item.exists_sql()."""
+        return self.get(item.key_value()) is not None
+
+    def item_needs_update(self, item: SqlItem) -> bool:
+        """Equivalent to item.needs_update_sql() not matching a row."""
+        update_cols = item._update_columns()
+        if update_cols is None:
+            return False
+
+        row = self.get(item.key_value())
+        if row is None:
+            return True
+        values = item_values(item)
+        return any(not values_match(values.get(c), row.get(c)) for c in update_cols)
+
+    def track_item(self, item: SqlItem) -> bool:
+        """Starts change tracking on item against its row here; False if there's no such row."""
+        row = self.get(item.key_value())
+        if row is None:
+            return False
+        item.mark_clean(row)
+        return True
+
+    def load_object(self, obj_type, key_value):
+        """Equivalent to DbWrapper.load_single_object, but returns None if there's no such row."""
+        row = self.get(key_value)
+        return _row_to_object(obj_type, row) if row else None
+
+    def store(self, values: Dict[str, Any]):
+        """Records an insert or update of the row with values[key_col]."""
+        row = self.get(values[self.key_col])
+        if row is None:
+            row = dict(values)
+            self.rows.append(row)
+            for (cols, numeric), index in self._indexes.items():
+                index.setdefault(_row_key(row, cols, numeric), row)
+            return
+
+        old_keys = {index_key: _row_key(row, *index_key) for index_key in self._indexes}
+        row.update(values)
+        for (cols, numeric), index in self._indexes.items():
+            old_key = old_keys[(cols, numeric)]
+            new_key = _row_key(row, cols, numeric)
+            if old_key != new_key and index.get(old_key) is row:
+                # Fall back to the next row that shares the old values, if any
+                del index[old_key]
+                for other in self.rows:
+                    if _row_key(other, cols, numeric) == old_key:
+                        index[old_key] = other
+                        break
+            index.setdefault(new_key, row)
+
+    def store_item(self, item: object, cols: List[str]=None):
+        """Records that item was written; if cols is set only those columns (and the key) changed."""
+        values = item_values(item)
+        if cols is not None:
+            values = {c: values.get(c) for c in [self.key_col] + list(cols)}
+        self.store(values)
+
+
+def load_snapshots(db_wrapper: DbWrapper, tables: Dict[str, str]) -> Dict[str, TableSnapshot]:
+    """Loads a snapshot for each table name -> key column."""
+    return {table_name: TableSnapshot(db_wrapper, table_name, key_col)
+            for table_name, key_col in tables.items()}
@@ -0,0 +1,149 @@
+"""
+Saves groups of SqlItems with a few bulk queries instead of several per item.
+
+DbWrapper.insert_or_update probes each item on its own (an exists and/or a
+needs-update SELECT) and autocommits every write. A UnitOfWork instead looks
+up the current rows for all the items of a class with one IN query, compares
+them locally, and queues the UPDATEs (and inserts of FK-keyed rows) to be sent
+with executemany, one call per statement template. Everything runs inside a
+single transaction that is committed when the unit of work ends.
+
+Inserts of rows with an auto-increment key are still sent one at a time as
+they are saved, since their new keys are needed to fill in child rows.
+"""
+
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from .db_util import DbWrapper
+from .sql_item import SqlItem, item_values, values_match
+from .table_snapshot import TableSnapshot
+
+logger = logging.getLogger('database')
+
+
+def _has_custom_lookup(item: SqlItem) -> bool:
+    # The existence/update checks are hand written SQL; there's no bulk equivalent.
+    cls = type(item)
+    return (item.uses_alternate_key_lookup() or
+            cls.exists_sql_params is not SqlItem.exists_sql_params or
+            cls.needs_update_sql_params is not SqlItem.needs_update_sql_params or
+            item._overrides_sql('exists_sql', 'exists_sql_params') or
+            item._overrides_sql('needs_update_sql', 'needs_update_sql_params'))
+
+
+def _item_differs(item: SqlItem, row: Dict[str, Any]) -> bool:
+    update_cols = item._update_columns()
+    if update_cols is None:
+        return False
+    values = item_values(item)
+    return any(not values_match(values.get(c), row.get(c)) for c in update_cols)
+
+
+class UnitOfWork(object):
+    """Collects the writes for a set of related items and commits them together.
+
+    Use as a context manager; call save() for each level of the object graph
+    (parents before children, since children need their parents' keys).
+    """
+
+    def __init__(self, db_wrapper: DbWrapper):
+        self.db_wrapper = db_wrapper
+        # SQL template -> rows of params, in the order they were queued
+        self.pending = OrderedDict()  # type: Dict[str, List[Tuple]]
+        self.inserted = 0
+        self.updated = 0
+        self._transaction = None
+        # Tracked items with a queued UPDATE; marked clean once it's committed
+        self._updated_items = []  # type: List[SqlItem]
+
+    def save(self, items: List[SqlItem]) -> List[Any]:
+        """Inserts or updates items as DbWrapper.insert_or_update would, returning their keys.
+
+        Updates are queued until flush(); new auto-increment rows are inserted right away.
+        """
+        keys = [None] * len(items)
+        by_class = OrderedDict()  # type: Dict[type, List[int]]
+        for idx, item in enumerate(items):
+            by_class.setdefault(type(item), []).append(idx)
+
+        for idxs in by_class.values():
+            for idx, key in zip(idxs, self._save_class([items[i] for i in idxs])):
+                keys[idx] = key
+        return keys
+
+    def _save_class(self, items: List[SqlItem]) -> List[Any]:
+        first = items[0]
+        if _has_custom_lookup(first):
+            return [self.db_wrapper.insert_or_update(item) for item in items]
+
+        local_key = first.uses_local_primary_key()
+        # Tracked items (loaded from the DB) already know whether they changed
+        lookup_items = [i for i in items if not i.tracks_changes() and not (local_key and i.needs_insert())]
+        key_col = first._key()
+        rows = self.db_wrapper.fetch_rows_in(first._table(), key_col, [i.key_value() for i in lookup_items])
+        existing = TableSnapshot(self.db_wrapper, first._table(), key_col, rows=rows)
+
+        keys = []
+        for item in items:
+            key = item.key_value()
+            if local_key and item.needs_insert():
+                logger.info('item needed insert: %s %s', type(item), key)
+                key = self.db_wrapper.insert_item(*item.insert_sql_params())
+                self.inserted += 1
+            elif item.tracks_changes():
+                if item.is_dirty():
+                    logger.info('item needed update: %s %s', type(item), key)
+                    self._queue_update(item)
+            else:
+                row = existing.get(key)
+                if row is None and not local_key:
+                    logger.info('item (fk) needed insert: %s %s', type(item), key)
+                    self._queue(*item.insert_sql_params())
+                    self.inserted += 1
+                elif row is None or _item_differs(item, row):
+                    logger.info('item needed update: %s %s', type(item), key)
+                    self._queue_update(item)
+            keys.append(key)
+        return keys
+
+    def _queue_update(self, item: SqlItem):
+        update = item.update_sql_params()
+        if update:
+            self._queue(*update)
+            self.updated += 1
+            if item.tracks_changes():
+                self._updated_items.append(item)
+
+    def _queue(self, sql: str, params: Tuple):
+        if params is None:
+            # Fully formatted statement from a subclass override; can't be batched.
+            self.db_wrapper.insert_item(sql)
+            return
+        self.pending.setdefault(sql, []).append(params)
+
+    def flush(self):
+        """Sends every queued statement, batched by template."""
+        for sql, rows in self.pending.items():
+            self.db_wrapper.execute_many(sql, rows)
+        self.pending = OrderedDict()
+
+    def __enter__(self):
+        self._transaction = self.db_wrapper.transaction()
+        self._transaction.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+                # The outermost transaction marks them clean if (and only if) it commits
+                for item in self._updated_items:
+                    self.db_wrapper.mark_clean_on_commit(item)
+        except BaseException as ex:
+            self._updated_items = []
+            self._transaction.__exit__(type(ex), ex, ex.__traceback__)
+            raise
+        self._updated_items = []
+        return self._transaction.__exit__(exc_type, exc_val, exc_tb)
@@ -73,4 +73,5 @@ class WaveItem(SqlItem):
         return WaveItem.KEY_COL
 
     def _insert_columns(self):
-        return self.__dict__.keys()
+        # Skip private state such as the change tracking snapshot
+        return [k for k in self.__dict__.keys() if not k.startswith('_')]
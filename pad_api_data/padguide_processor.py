@@ -14,18 +14,23 @@ import feedparser
 from pad_etl.common import monster_id_mapping
 from pad_etl.data import card, skill
 from pad_etl.data import database
+from pad_etl.data import raw_delta
 from pad_etl.processor import skill_info
 from pad_etl.processor.merged_data import MergedCard, CrossServerCard
 from pad_etl.storage import egg
 from pad_etl.storage import egg_processor
 from pad_etl.storage import monster
 from pad_etl.storage import monster_skill
+from pad_etl.storage import sequence
 from pad_etl.storage import skill_data
+from pad_etl.storage import table_snapshot
 from pad_etl.storage import timestamp_processor
 
-from pad_etl.storage.db_util import DbWrapper
+from pad_etl.storage.db_util import BatchWriter, DbWrapper
 from pad_etl.storage.news import NewsItem
+from pad_etl.storage.query_stats import QueryStats
 from pad_etl.storage.schedule_item import ScheduleItem
+from pad_etl.storage.sql_item import process_col_mappings
 
 
 logging.basicConfig()
@@ -57,18 +62,30 @@ def parse_args():
     inputGroup.add_argument("--logsql", default=False,
                             action="store_true", help="Logs sql commands")
     inputGroup.add_argument("--skipintermediate", default=False,
-                            action="store_true", help="Skips the slow intermediate storage")
+                            action="store_true", help="Skips the intermediate storage")
+    inputGroup.add_argument("--bulk_diff", default=False, action="store_true",
+                            help="Reads the card tables once and diffs locally instead of querying per item")
     inputGroup.add_argument("--db_config", required=True, help="JSON database info")
     inputGroup.add_argument("--dev", default=False, action="store_true",
                             help="Should we run dev processes")
     inputGroup.add_argument("--input_dir", required=True,
                             help="Path to a folder where the input data is")
+    inputGroup.add_argument("--cache_dir", required=False,
+                            help="Path to a folder where parsed snapshots of the input data are cached")
+    inputGroup.add_argument("--load_workers", type=int, required=False,
+                            help="Number of processes used to parse servers whose --cache_dir snapshot is out of date")
+    inputGroup.add_argument("--previous_input_dir", required=False,
+                            help="Path to the previous pull's input data; if set, the raw changes are saved")
 
     outputGroup = parser.add_argument_group("Output")
     outputGroup.add_argument("--output_dir", required=True,
                              help="Path to a folder where output should be saved")
+    outputGroup.add_argument("--query_report", required=False,
+                             help="Write a JSON report of DB query timings and round trips per phase here")
     outputGroup.add_argument("--pretty", default=False, action="store_true",
                              help="Controls pretty printing of results")
+    outputGroup.add_argument("--intermediate_compression", choices=['gzip', 'zstd'], required=False,
+                             help="Compresses the intermediate files (zstd needs the zstandard package)")
 
     helpGroup = parser.add_argument_group("Help")
     helpGroup.add_argument("-h", "--help", action="help",
@@ -260,18 +277,27 @@ def database_diff_events(db_wrapper, database):
             debug_events.append((schedule_item, merged_event))
             schedule_events.append(schedule_item)
 
-    next_id = db_wrapper.get_single_value(
-        'SELECT 1 + COALESCE(MAX(CAST(schedule_seq AS SIGNED)), 30000) FROM schedule_list', op=int)
-
-    logger.info('updating event db starting at %i', next_id)
+    logger.info('updating event db')
 
+    # Inserts are batched, so also skip duplicates of events queued earlier in this run
+    queued_events = set()
+    to_insert = []
     for se in schedule_events:
-        if db_wrapper.check_existing(se.exists_sql()):
+        exists_sql = se.exists_sql()
+        if exists_sql in queued_events or db_wrapper.check_existing(exists_sql):
             logger.debug('event already exists, skipping, %s', repr(se))
         else:
-            logger.warn('inserting item: %s', repr(se))
-            db_wrapper.insert_item(se.insert_sql(next_id))
-            next_id += 1
+            to_insert.append(se)
+            queued_events.add(exists_sql)
+
+    if to_insert:
+        # Reserve exactly the IDs needed so no block is left unused
+        start, _ = sequence.allocator_for(db_wrapper, ScheduleItem.TABLE).reserve(len(to_insert))
+        with BatchWriter(db_wrapper, ScheduleItem.TABLE, ScheduleItem.INSERT_COLUMNS) as schedule_writer:
+            for idx, se in enumerate(to_insert):
+                logger.warn('inserting item: %s', repr(se))
+                se.schedule_seq = start + idx
+                schedule_writer.add(se)
 
     print('dumping all events\n')
     for de in debug_events:
@@ -303,7 +329,22 @@ def make_cross_server_card(jp_card: MergedCard, na_card: MergedCard) -> (CrossSe
     return CrossServerCard(monster_no, jp_card, na_card), None
 
 
-def database_diff_cards(db_wrapper, jp_database, na_database):
+# Tables read up front by database_diff_cards in bulk mode, with their key column.
+CARD_DIFF_TABLES = {
+    'monster_list': 'monster_no',
+    'monster_info_list': 'monster_no',
+    'monster_add_info_list': 'monster_no',
+    'monster_price_list': 'monster_no',
+    'awoken_skill_list': 'tma_seq',
+    'evolution_list': 'tv_seq',
+    'evo_material_list': 'tem_seq',
+    'skill_list': 'ts_seq',
+    'skill_data_list': 'ts_seq',
+    'skill_leader_data_list': 'ts_seq',
+}
+
+
+def database_diff_cards(db_wrapper, jp_database, na_database, bulk_diff=False):
     jp_card_ids = [mc.card.card_id for mc in jp_database.cards]
     jp_id_to_card = {mc.card.card_id: mc for mc in jp_database.cards}
     na_id_to_card = {mc.card.card_id: mc for mc in na_database.cards}
@@ -323,20 +364,63 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
         elif err_msg:
             fail_logger.debug('Skipping card, %s', err_msg)
 
+    # In bulk mode, every table is read once and items are diffed against the local copy
+    # instead of running a few SELECTs per item.
+    snapshots = table_snapshot.load_snapshots(db_wrapper, CARD_DIFF_TABLES) if bulk_diff else {}
+    # Dry runs write nothing, so later lookups mustn't see their writes either
+    store_writes = bulk_diff and not db_wrapper.dry_run
+
+    def item_exists(item: monster.SqlItem):
+        if bulk_diff:
+            return snapshots[item._table()].has_item(item)
+        return db_wrapper.check_existing(*item.exists_sql_params())
+
+    def item_needs_update(item: monster.SqlItem):
+        if bulk_diff:
+            return snapshots[item._table()].item_needs_update(item)
+        return db_wrapper.item_needs_update(item)
+
+    def insert_item(item: monster.SqlItem):
+        db_wrapper.insert_item(*item.insert_sql_params())
+        if store_writes:
+            snapshots[item._table()].store_item(item)
+
+    def update_item(item: monster.SqlItem):
+        db_wrapper.insert_item(*item.update_sql_params())
+        if store_writes:
+            snapshots[item._table()].store_item(item, item._update_columns() + ['tstamp'])
+
+    def lookup_value(sql: str, table_name: str, value_col: str, **where_values):
+        """Single value lookup; equivalent to running sql through get_single_value."""
+        if not bulk_diff:
+            return db_wrapper.get_single_value(sql, op=int)
+        row = snapshots[table_name].find(**where_values)
+        if row is None:
+            if db_wrapper.dry_run:
+                return None
+            raise ValueError('got zero results:', sql)
+        return int(row[value_col])
+
+    def lookup_existing_value(sql: str, table_name: str, value_col: str, **where_values):
+        """Optional value lookup; equivalent to running sql through check_existing_value."""
+        if not bulk_diff:
+            return db_wrapper.check_existing_value(sql)
+        row = snapshots[table_name].find(**where_values)
+        return row[value_col] if row else None
+
     def insert_or_update(item: monster.SqlItem):
         # Check if the item exists by key
-        if db_wrapper.check_existing(item.exists_sql()):
+        if item_exists(item):
             # It exists, check if the updatable values have changed
-            update_sql = item.needs_update_sql()
-            if update_sql and not db_wrapper.check_existing(update_sql):
+            if item_needs_update(item):
                 logger.warn('Updating: %s', repr(item))
-                db_wrapper.insert_item(item.update_sql())
+                update_item(item)
             else:
                 fail_logger.debug('Skipping existing item that needs no updates: %s', repr(item))
         else:
             # This is a new item, so populate it
             logger.warn('Inserting new item: %s', repr(item))
-            db_wrapper.insert_item(item.insert_sql())
+            insert_item(item)
 
     # Base monster
     for csc in combined_cards:
@@ -355,39 +439,45 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
         insert_or_update(monster.MonsterPriceItem(csc.jp_card.card))
 
     # Awakenings
+    db_wrapper.set_phase('awakenings')
     awakening_name_and_id = db_wrapper.fetch_data(monster.awoken_name_id_sql())
     awoken_name_to_id = {row['name']: row['ts_seq'] for row in awakening_name_and_id}
 
-    next_awakening_id = db_wrapper.get_single_value(
-        'SELECT 1 + COALESCE(MAX(CAST(tma_seq AS SIGNED)), 20000) FROM awoken_skill_list', op=int)
+    awakening_ids = sequence.allocator_for(db_wrapper, 'awoken_skill_list')
 
     for csc in combined_cards:
         awakenings = monster.card_to_awakenings(awoken_name_to_id, csc.jp_card.card)
         for item in awakenings:
-            tma_seq = db_wrapper.check_existing_value(item.exists_by_values_sql())
+            tma_seq = lookup_existing_value(item.exists_by_values_sql(), 'awoken_skill_list', 'tma_seq',
+                                            monster_no=item.monster_no, order_idx=item.order_idx)
             if tma_seq:
                 item.tma_seq = tma_seq
             else:
-                item.tma_seq = next_awakening_id
-                next_awakening_id += 1
+                item.tma_seq = awakening_ids.next_id()
             insert_or_update(item)
 
     # Evolutions
-    next_evo_id = db_wrapper.get_single_value(
-        'SELECT 1 + COALESCE(MAX(CAST(tv_seq AS SIGNED)), 4000) FROM evolution_list', op=int)
+    db_wrapper.set_phase('evolutions')
+    evo_ids = sequence.allocator_for(db_wrapper, 'evolution_list')
 
     for csc in combined_cards:
         evolution = monster.EvolutionItem(csc.jp_card.card)
         if not evolution.is_valid():
             continue
-        if db_wrapper.check_existing(evolution.exists_sql()):
+        if bulk_diff:
+            evolution_exists = snapshots['evolution_list'].find(to_no=evolution.to_no) is not None
+        else:
+            evolution_exists = db_wrapper.check_existing(evolution.exists_sql())
+        if evolution_exists:
             fail_logger.debug('Skipping existing evolution: %s', repr(evolution))
         else:
             logger.warn('Inserting new evolution: %s', repr(evolution))
-            db_wrapper.insert_item(evolution.insert_sql(next_evo_id))
-            next_evo_id += 1
+            db_wrapper.insert_item(evolution.insert_sql(evo_ids.next_id()))
+            if store_writes:
+                snapshots['evolution_list'].store_item(evolution)
 
     # Try to populate series if missing.
+    db_wrapper.set_phase('series')
 
     # First stage.
     # 1) Pull the list of monster_no -> series_id from the DB.
@@ -450,27 +540,28 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
                 csc.monster_no, new_series_id))
 
     # Evo mats
-    next_evo_mat_id = db_wrapper.get_single_value(
-        'SELECT 1 + COALESCE(MAX(CAST(tem_seq AS SIGNED)), 15000) FROM evo_material_list', op=int)
+    db_wrapper.set_phase('evo_mats')
+    evo_mat_ids = sequence.allocator_for(db_wrapper, 'evo_material_list')
 
     for csc in combined_cards:
         card = csc.jp_card.card
         if not card.ancestor_id:
             continue
-        tv_seq = db_wrapper.get_single_value(monster.lookup_evo_id_sql(card), op=int)
+        tv_seq = lookup_value(monster.lookup_evo_id_sql(card), 'evolution_list', 'tv_seq',
+                              to_no=monster_id_mapping.jp_id_to_monster_no(card.card_id))
         evo_mat_items = monster.card_to_evo_mats(card, tv_seq)
         for item in evo_mat_items:
-            tem_seq = db_wrapper.check_existing_value(item.exists_by_values_sql())
+            tem_seq = lookup_existing_value(item.exists_by_values_sql(), 'evo_material_list', 'tem_seq',
+                                            order_idx=item.order_idx, tv_seq=item.tv_seq)
             if tem_seq:
                 item.tem_seq = tem_seq
             else:
-                item.tem_seq = next_evo_mat_id
-                next_evo_mat_id += 1
+                item.tem_seq = evo_mat_ids.next_id()
             insert_or_update(item)
 
     # Skills
-    next_skill_id = db_wrapper.get_single_value(
-        'SELECT 1 + COALESCE(MAX(CAST(ts_seq AS SIGNED)), 20000) FROM skill_list', op=int)
+    db_wrapper.set_phase('skills')
+    skill_ids = sequence.allocator_for(db_wrapper, 'skill_list')
 
     # Compute English skill text
     calc_skills = skill_info.reformat_json_info(jp_database.raw_skills)
@@ -488,7 +579,10 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
         merged_card_na = csc.na_card
         monster_no = csc.monster_no
 
-        info = db_wrapper.get_single_or_no_row(monster_skill.get_monster_skill_ids(merged_card))
+        if bulk_diff:
+            info = snapshots['monster_list'].get(monster_no)
+        else:
+            info = db_wrapper.get_single_or_no_row(monster_skill.get_monster_skill_ids(merged_card))
         if not info:
             fail_logger.warn('Unexpected empty skill lookup: %s', repr(merged_card))
             continue
@@ -502,8 +596,9 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
                 return
 
             # An existing card already has this skill, look it up
-            ts_seq = db_wrapper.get_single_value(
-                "select {} from monster_list where monster_no = {}".format(field_name, alt_monster_no), op=int)
+            ts_seq = lookup_value(
+                "select {} from monster_list where monster_no = {}".format(field_name, alt_monster_no),
+                'monster_list', field_name, monster_no=alt_monster_no)
             logger.warn('Looked up existing skill id %s from %s for %s',
                         ts_seq, alt_monster_no, merged_card)
             return ts_seq
@@ -514,15 +609,13 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
 
             if ts_seq is None:
                 # Lookup failed, insert a new skill
-                nonlocal next_skill_id
+                ts_seq = skill_ids.next_id()
                 item = monster_skill.MonsterSkillItem(
-                    next_skill_id, skill_value, na_skill_value, calc_skill_description)
+                    ts_seq, skill_value, na_skill_value, calc_skill_description)
 
                 logger.warn('Inserting new monster skill: %s - %s',
                             repr(merged_card), repr(item))
-                db_wrapper.insert_item(item.insert_sql())
-                ts_seq = next_skill_id
-                next_skill_id += 1
+                insert_item(item)
 
             return ts_seq
 
@@ -531,14 +624,14 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
             item = monster_skill.MonsterSkillItem(
                 ts_seq, skill_value, na_skill_value, calc_skill_description)
 
-            if not db_wrapper.check_existing(item.exists_sql()):
+            if not item_exists(item):
                 fail_logger.fatal('Unexpected empty skill lookup: %s', repr(item))
                 exit()
 
             # It exists, check if the updatable values have changed
-            if not db_wrapper.check_existing(item.needs_update_sql()):
+            if item_needs_update(item):
                 logger.warn('Updating: %s', repr(item))
-                db_wrapper.insert_item(item.update_sql())
+                update_item(item)
             else:
                 fail_logger.debug(
                     'Skipping existing item that needs no updates: %s', repr(item))
@@ -548,7 +641,10 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
         def update_skill_data(ts_seq, as_desc=None, ls_desc=None):
             if not ts_seq or not (as_desc or ls_desc):
                 return
-            skill_data_item = db_wrapper.load_single_object(skill_data.SkillData, ts_seq)
+            if bulk_diff:
+                skill_data_item = snapshots['skill_data_list'].load_object(skill_data.SkillData, ts_seq)
+            else:
+                skill_data_item = db_wrapper.load_single_object(skill_data.SkillData, ts_seq)
             if not skill_data_item:
                 skill_data_item = skill_data.SkillData(ts_seq=ts_seq)
             if as_desc:
@@ -556,7 +652,14 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
             else:
                 conditions = skill_data.parse_ls_conditions(ls_desc)
             skill_data_item.type_data = skill_data.format_conditions(conditions)
-            db_wrapper.insert_or_update(skill_data_item)
+            if not bulk_diff:
+                db_wrapper.insert_or_update(skill_data_item)
+            elif not item_exists(skill_data_item):
+                logger.info('item (fk) needed insert: %s %s', type(skill_data_item), ts_seq)
+                insert_item(skill_data_item)
+            elif item_needs_update(skill_data_item):
+                logger.info('item (fk) needed update: %s %s', type(skill_data_item), ts_seq)
+                update_item(skill_data_item)
 
         ts_seq_leader = info['ts_seq_leader']
         if merged_card.leader_skill:
@@ -601,6 +704,11 @@ def database_diff_cards(db_wrapper, jp_database, na_database):
                         repr(merged_card), ts_seq_leader, ts_seq_skill)
             db_wrapper.insert_item(monster_skill.get_update_monster_skill_ids(
                 merged_card, ts_seq_leader, ts_seq_skill))
+            if store_writes:
+                # Keyed the same way as the update statement above
+                snapshots['monster_list'].store({'monster_no': merged_card.card.card_id,
+                                                 'ts_seq_leader': ts_seq_leader,
+                                                 'ts_seq_skill': ts_seq_skill})
 
 
 def database_update_egg_machines(db_wrapper, jp_database, na_database):
@@ -619,16 +727,14 @@ def database_update_egg_machines(db_wrapper, jp_database, na_database):
 def database_update_news(db_wrapper):
     RENI_NEWS_JP = 'https://pad.protic.site/news/category/pad-jp/feed'
     jp_feed = feedparser.parse(RENI_NEWS_JP)
-    next_id = db_wrapper.get_single_value(
-        'SELECT 1 + COALESCE(MAX(CAST(tn_seq AS SIGNED)), 10000) FROM news_list', op=int)
+    news_ids = sequence.allocator_for(db_wrapper, 'news_list')
     for entry in jp_feed.entries:
         item = NewsItem('JP', entry.title, entry.link)
         if db_wrapper.check_existing(item.exists_sql()):
             logger.debug('news already exists, skipping, %s', repr(item))
         else:
             logger.warn('inserting item: %s', repr(item))
-            db_wrapper.insert_item(item.insert_sql(next_id))
-            next_id += 1
+            db_wrapper.insert_item(item.insert_sql(news_ids.next_id()))
 
 
 def database_update_timestamps(db_wrapper):
@@ -656,47 +762,66 @@ def load_data(args):
     output_dir = args.output_dir
 
     logger.info('Loading data')
-    jp_database = database.Database('jp', input_dir)
-    jp_database.load_database()
-
-    na_database = database.Database('na', input_dir)
-    na_database.load_database()
+    databases = database.load_all_servers(['jp', 'na'], input_dir,
+                                          workers=args.load_workers, cache_dir=args.cache_dir)
+    jp_database = databases['jp']
+    na_database = databases['na']
+
+    if args.previous_input_dir:
+        logger.info('Computing raw data changes')
+        for server in ['jp', 'na']:
+            change_set = raw_delta.compute_change_set(os.path.join(args.previous_input_dir, server),
+                                                      os.path.join(input_dir, server), server)
+            logger.info('Raw data changes: %s', repr(change_set))
+            change_set.save(os.path.join(output_dir, '{}_raw_delta.json'.format(server)))
 
     if not args.skipintermediate:
         logger.info('Storing intermediate data')
-        jp_database.save_all(output_dir, args.pretty)
-        na_database.save_all(output_dir, args.pretty)
+        jp_database.save_all(output_dir, args.pretty, compression=args.intermediate_compression)
+        na_database.save_all(output_dir, args.pretty, compression=args.intermediate_compression)
 
     logger.info('Connecting to database')
     with open(args.db_config) as f:
         db_config = json.load(f)
 
-    db_wrapper = DbWrapper(dry_run)
+    stats = QueryStats() if args.query_report else None
+    db_wrapper = DbWrapper(dry_run, stats=stats)
     db_wrapper.connect(db_config)
+    sequence.bootstrap(db_wrapper)
 
     logger.info('Starting JP event diff')
-    database_diff_events(db_wrapper, jp_database)
+    with db_wrapper.phase('events'):
+        database_diff_events(db_wrapper, jp_database)
 
     logger.info('Starting NA event diff')
-    database_diff_events(db_wrapper, na_database)
+    with db_wrapper.phase('events'):
+        database_diff_events(db_wrapper, na_database)
 
     logger.info('Starting card diff')
-    database_diff_cards(db_wrapper, jp_database, na_database)
+    with db_wrapper.phase('cards'):
+        database_diff_cards(db_wrapper, jp_database, na_database, bulk_diff=args.bulk_diff)
 
     logger.info('Starting egg machine update')
     try:
-        database_update_egg_machines(db_wrapper, jp_database, na_database)
+        with db_wrapper.phase('eggs'):
+            database_update_egg_machines(db_wrapper, jp_database, na_database)
     except Exception as ex:
         print('updating egg machines failed', str(ex))
 
     logger.info('Starting news update')
     try:
-        database_update_news(db_wrapper)
+        with db_wrapper.phase('news'):
+            database_update_news(db_wrapper)
     except Exception as ex:
         print('updating news failed', str(ex))
 
     logger.info('Starting tstamp update')
-    timestamp_processor.update_timestamps(db_wrapper)
+    with db_wrapper.phase('timestamps'):
+        timestamp_processor.update_timestamps(db_wrapper)
+
+    if stats:
+        logger.info('Writing query report')
+        stats.save(args.query_report)
 
     print('done')
 
@@ -32,7 +32,7 @@ args = parse_args()
 dungeon_id = int(args.dungeon_id) if args.dungeon_id else None
 
 na_database = database.Database('na', args.raw_input_dir)
-na_database.load_database(skip_skills=True, skip_bonus=True, skip_extra=True)
+na_database.load_database(lazy=True)
 
 dungeon_id_to_wavedata = defaultdict(list)
 wave_summary_data = wave.load_wave_summary(args.processed_input_dir)
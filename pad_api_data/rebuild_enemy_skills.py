@@ -21,10 +21,14 @@ def parse_args():
     inputGroup = parser.add_argument_group("Input")
     inputGroup.add_argument("--input_dir", required=True,
                             help="Path to a folder where the input data is")
+    inputGroup.add_argument("--cache_dir", required=False,
+                            help="Path to a folder where parsed snapshots of the input data are cached")
     inputGroup.add_argument("--card_id", required=False,
                             help="Process only this card")
     inputGroup.add_argument("--interactive", required=False,
                             help="Lets you specify a card id on the command line")
+    inputGroup.add_argument("--max_turns", type=int, default=enemy_skillset_processor.DEFAULT_MAX_TURNS,
+                            help="Most turns to simulate per HP checkpoint while looking for a loop")
 
     helpGroup = parser.add_argument_group("Help")
     helpGroup.add_argument("-h", "--help", action="help",
@@ -32,24 +36,30 @@ def parse_args():
     return parser.parse_args()
 
 
-def process_card(mcard):
+def process_card(mcard, enemy_skill_registry, max_turns):
+    """Dumps the card's skillset, returning the levels whose simulation hit max_turns."""
     enemy_behavior = mcard.enemy_behavior
     card = mcard.card
     enemy_skill_effect = card.enemy_skill_effect
     enemy_skill_effect_type = card.enemy_skill_effect_type
     if not enemy_behavior:
-        return
+        return []
 
     levels = enemy_skillset_processor.extract_levels(enemy_behavior)
     skill_listings = []
     used_actions = []
+    ceiling_levels = []
     for level in sorted(levels):
         skillset = enemy_skillset_processor.convert(
             card,
             enemy_behavior,
             level, enemy_skill_effect,
             enemy_skill_effect_type,
-            force_one_enemy=(int(card.unknown_009) == 5))
+            enemy_skill_registry,
+            force_one_enemy=(int(card.unknown_009) == 5),
+            max_turns=max_turns)
+        if skillset.turn_ceiling_hps:
+            ceiling_levels.append(level)
         flattened = enemy_skillset_dump.flatten_skillset(level, skillset)
         if not flattened.records:
             continue
@@ -57,7 +67,7 @@ def process_card(mcard):
         skill_listings.append(flattened)
 
     if not skill_listings:
-        return
+        return ceiling_levels
 
     unused_actions = []
     for b in enemy_behavior:
@@ -68,17 +78,20 @@ def process_card(mcard):
         card.card_id, card.name, 'not yet populated')
     if unused_actions:
         entry_info.warnings.append('Found {} unused actions'.format(len(unused_actions)))
+    if ceiling_levels:
+        entry_info.warnings.append('No exact loop within {} turns at levels {}'.format(max_turns, ceiling_levels))
 
     summary = enemy_skillset_dump.EnemySummary(entry_info, skill_listings)
     # TODO: turn this on
     # summary = enemy_skillset_dump.load_and_merge_summary(summary)
 
     enemy_skillset_dump.dump_summary_to_file(card, summary, enemy_behavior, unused_actions)
+    return ceiling_levels
 
 
 def run(args):
     raw_input_dir = os.path.join(args.input_dir, 'raw')
-    db = database.Database('na', raw_input_dir)
+    db = database.Database('na', raw_input_dir, cache_dir=args.cache_dir)
     db.load_database(skip_skills=True, skip_bonus=True, skip_extra=True)
 
     fixed_card_id = args.card_id
@@ -86,6 +99,7 @@ def run(args):
         fixed_card_id = input("enter a card id:").strip()
 
     count = 0
+    ceiling_cards = []
     for card in db.cards:
         if fixed_card_id and card.card.card_id != int(fixed_card_id):
             continue
@@ -93,7 +107,8 @@ def run(args):
             count += 1
             if count % 50 == 0:
                 print('processing {} of {}'.format(count, len(db.cards)))
-            process_card(card)
+            if process_card(card, db.enemy_skill_registry, args.max_turns):
+                ceiling_cards.append(card.card)
         except Exception as ex:
             print('failed to process', card.card.name)
             print(ex)
@@ -101,6 +116,11 @@ def run(args):
                 import traceback
                 traceback.print_exc()
 
+    if ceiling_cards:
+        print('{} monsters had no exact loop within {} turns:'.format(len(ceiling_cards), args.max_turns))
+        for card in ceiling_cards:
+            print('  {} {}'.format(card.card_id, card.name))
+
 
 if __name__ == '__main__':
     args = parse_args()